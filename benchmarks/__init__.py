@@ -0,0 +1 @@
+"""mailAttachmentPrinter benchmarks"""
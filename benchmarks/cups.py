@@ -0,0 +1,106 @@
+"""mailAttachmentPrinter benchmark cups stand-in
+
+implements the part of pycups used by core.printer and core.jobs and records every submitted document,
+it is installed as module 'cups' by the benchmark before core is imported."""
+from threading import Lock
+from time import perf_counter
+
+CUPS_FORMAT_AUTO = "application/octet-stream"
+HTTP_CONTINUE = 100
+HTTP_OK = 200
+IPP_JOB_PENDING = 3
+IPP_JOB_HELD = 4
+IPP_JOB_PROCESSING = 5
+IPP_JOB_STOPPED = 6
+IPP_JOB_CANCELED = 7
+IPP_JOB_ABORTED = 8
+IPP_JOB_COMPLETED = 9
+IPP_PRINTER_IDLE = 3
+IPP_PRINTER_STOPPED = 5
+
+class IPPError(Exception):
+    """error of an ipp request"""
+
+class HTTPError(Exception):
+    """error of the http connection"""
+
+PRINTERS = ["Benchmark_Printer"]
+# job id -> {"printer", "title", "documents": [(perf_counter time, data)]}, every job is completed immediately
+JOBS = {}
+_LOCK = Lock()
+_SERVER = "localhost"
+
+def setServer(server) -> None:
+    global _SERVER
+    _SERVER = server
+
+def getServer() -> str:
+    return _SERVER
+
+def reset() -> None:
+    """forget all recorded jobs"""
+    with _LOCK:
+        JOBS.clear()
+
+def documents() -> list:
+    """return (perf_counter time, data) of all recorded documents"""
+    with _LOCK:
+        return [document for job in JOBS.values() for document in job["documents"]]
+
+def _new_job(printer, title) -> int:
+    """record a new job and return its id"""
+    with _LOCK:
+        job_id = len(JOBS) + 1
+        JOBS[job_id] = {"printer": printer, "title": title, "documents": []}
+    return job_id
+
+class Connection:
+    """connection to the recording cups server"""
+    def __init__(self, host=None, port=None, encryption=None):
+        self.document = None
+
+    def getPrinters(self) -> dict:
+        return {name: {"printer-state": IPP_PRINTER_IDLE, "printer-is-accepting-jobs": True} for name in PRINTERS}
+
+    def getPrinterAttributes(self, name=None, uri=None, requested_attributes=None) -> dict:
+        return {"multiple-document-jobs-supported": True}
+
+    def getJobs(self, which_jobs="not-completed", my_jobs=False, limit=-1, first_job_id=-1, requested_attributes=None) -> dict:
+        if which_jobs == "not-completed":
+            return {}
+        with _LOCK:
+            return {job_id: {"job-state": IPP_JOB_COMPLETED} for job_id in JOBS if job_id >= first_job_id}
+
+    def cancelJob(self, job_id, purge_job=False) -> None:
+        pass
+
+    def printFile(self, printer, filename, title, options) -> int:
+        with open(filename, "rb") as document:
+            data = document.read()
+        job_id = _new_job(printer, title)
+        JOBS[job_id]["documents"].append((perf_counter(), data))
+        return job_id
+
+    def printFiles(self, printer, filenames, title, options) -> int:
+        job_id = _new_job(printer, title)
+        for filename in filenames:
+            with open(filename, "rb") as document:
+                JOBS[job_id]["documents"].append((perf_counter(), document.read()))
+        return job_id
+
+    def createJob(self, printer, title, options) -> int:
+        return _new_job(printer, title)
+
+    def startDocument(self, printer, job_id, name, format, last_document) -> int:
+        self.document = (job_id, [])
+        return HTTP_CONTINUE
+
+    def writeRequestData(self, buffer, length) -> int:
+        self.document[1].append(bytes(buffer[:length]))
+        return HTTP_CONTINUE
+
+    def finishDocument(self, printer) -> int:
+        job_id, chunks = self.document
+        JOBS[job_id]["documents"].append((perf_counter(), b"".join(chunks)))
+        self.document = None
+        return HTTP_OK
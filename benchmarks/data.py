@@ -0,0 +1,48 @@
+"""mailAttachmentPrinter benchmark data"""
+from datetime import datetime,timedelta
+from email.message import EmailMessage
+from os.path import join
+
+from core.config import TIDES_ENCODING
+
+def attachment(mail, number, size) -> bytes:
+    """return a pdf-like attachment of a size, its first line identifies the mail"""
+    header = f"%PDF-1.4\n% benchmark mail {mail} attachment {number}\n".encode()
+    return header + bytes(max(0, size - len(header)))
+
+def mail_number(document) -> int:
+    """return the number of the mail an attachment belongs to"""
+    return int(document.split(b"\n", 2)[1].split()[3])
+
+def make_mail(number, sizes, images=0, sender="scanner@benchmark.local") -> bytes:
+    """return a mail with a text part, inline images and a pdf attachment per size"""
+    message = EmailMessage()
+    message["From"] = sender
+    message["To"] = "printer@benchmark.local"
+    message["Subject"] = f"Scan {number}"
+    message.set_content("Please find the scanned document attached.")
+    for image in range(images):
+        message.add_attachment(b"\x89PNG" + bytes(64 * 1024), maintype="image", subtype="png", filename=f"logo{image}.png", disposition="inline")
+    for position, size in enumerate(sizes):
+        message.add_attachment(attachment(number, position, size), maintype="application", subtype="pdf", filename=f"scan{number}_{position}.pdf")
+    return message.as_bytes()
+
+def make_tide_files(directory, random, stations=("DE__505P",), years=(2026, 2027)) -> list:
+    """write BSH tide files with an event every 6 hours and some minutes, return their paths"""
+    paths = []
+    for station in stations:
+        for year in years:
+            rows = [f"A03#  #{station}  #", f"A04#  #Station {station}#", f"A06#  #{year}#"]
+            event_time = datetime(year, 1, 1, 0, 30)
+            tide_type = "H"
+            while event_time.year == year:
+                moon_phase = random.choice("0123") if random.random() < 0.03 else " "
+                height = 1.9 + random.random() if tide_type == "H" else -0.2 + random.random() / 2
+                rows.append(f"VB2#  #{moon_phase}#{tide_type}#x#{event_time:%d.%m.%Y}#{event_time:%H:%M}# {height:.2f}#")
+                event_time += timedelta(hours=6, minutes=12 + random.randint(0, 5))
+                tide_type = "N" if tide_type == "H" else "H"
+            path = join(directory, f"{station}_{year}.txt")
+            with open(path, "w", encoding=TIDES_ENCODING) as tide_file:
+                tide_file.write("\n".join(rows) + "\n")
+            paths.append(path)
+    return paths
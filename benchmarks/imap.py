@@ -0,0 +1,300 @@
+"""mailAttachmentPrinter benchmark imap server"""
+from email import message_from_bytes
+from email.policy import compat32
+from email.utils import getaddresses
+from imaplib import Time2Internaldate
+from re import I,findall,match
+from socketserver import StreamRequestHandler,ThreadingTCPServer
+from threading import Lock,Thread
+from time import time
+
+def __quote(value) -> str:
+    """return a value as imap quoted string or NIL"""
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def __parameters(part, header="Content-Type") -> str:
+    """return the parameters of a header as imap list"""
+    parameters = (part.get_params(header=header) or [])[1:]
+    if not parameters:
+        return "NIL"
+    return "(" + " ".join(f"{__quote(key.upper())} {__quote(value)}" for key, value in parameters) + ")"
+
+def __disposition(part) -> str:
+    """return the content disposition of a part as imap list"""
+    if part.get("Content-Disposition") is None:
+        return "NIL"
+    return f"({__quote(part.get_content_disposition().upper())} {__parameters(part, 'Content-Disposition')})"
+
+def _body(part) -> bytes:
+    """return the still encoded body of a part"""
+    payload = part.get_payload(decode=False)
+    return payload.encode("latin-1", "replace") if isinstance(payload, str) else b""
+
+def _bodystructure(part) -> str:
+    """return the BODYSTRUCTURE of a message"""
+    if part.get_content_type() == "message/rfc822":
+        inner = part.get_payload(0)
+        raw = inner.as_bytes()
+        envelope = "(" + " ".join(["NIL"] * 10) + ")"
+        return f'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" {len(raw)} {envelope} {_bodystructure(inner)} {len(raw.splitlines())} NIL {__disposition(part)} NIL NIL)'
+    if part.is_multipart():
+        children = "".join(_bodystructure(child) for child in part.get_payload())
+        return f"({children} {__quote(part.get_content_subtype().upper())} {__parameters(part)} NIL NIL NIL)"
+    body = _body(part)
+    encoding = (part.get("Content-Transfer-Encoding") or "7BIT").upper()
+    fields = f"{__quote(part.get_content_maintype().upper())} {__quote(part.get_content_subtype().upper())} {__parameters(part)} NIL NIL {__quote(encoding)} {len(body)}"
+    if part.get_content_maintype() == "text":
+        fields += f" {len(body.splitlines())}"
+    return f"({fields} NIL {__disposition(part)} NIL NIL)"
+
+def _envelope(message) -> str:
+    """return the ENVELOPE of a message"""
+    def addresses(header):
+        found = getaddresses(message.get_all(header, []))
+        if not found:
+            return "NIL"
+        return "(" + "".join(f"({__quote(name or None)} NIL {__quote(address.split('@')[0])} {__quote(address.split('@')[-1])})" for name, address in found) + ")"
+    return "(" + " ".join([__quote(message.get("Date")), __quote(message.get("Subject")), addresses("From"), addresses("From"), addresses("From"),
+                           addresses("To"), addresses("Cc"), addresses("Bcc"), __quote(message.get("In-Reply-To")), __quote(message.get("Message-ID"))]) + ")"
+
+def _section(message, section) -> bytes:
+    """return the body of a section like 2 or 3.1"""
+    part = message
+    for index in section.split("."):
+        if part.get_content_type() == "message/rfc822":
+            part = part.get_payload(0)
+            if not part.is_multipart():
+                continue
+        if part.is_multipart():
+            part = part.get_payload()[int(index) - 1]
+        elif index != "1":
+            return b""
+    return _body(part)
+
+def _in_set(value, message_set, maximum) -> bool:
+    """return True if a number is part of an imap message set"""
+    for piece in message_set.split(","):
+        low, _, high = piece.partition(":")
+        low = maximum if low == "*" else int(low)
+        high = low if high == "" else maximum if high == "*" else int(high)
+        if min(low, high) <= value <= max(low, high):
+            return True
+    return False
+
+class Mailbox:
+    """messages of a mailbox with their uids, flags and modseqs"""
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.modseq = 1
+        self.messages = []
+        self.lock = Lock()
+        # connections in IDLE which are notified about new messages
+        self.idlers = []
+
+    def append(self, raw, seen=False) -> int:
+        """add a message and notify idling connections, return its uid"""
+        with self.lock:
+            self.modseq += 1
+            message = {"uid": self.uidnext, "flags": {"\\Seen"} if seen else set(), "raw": raw, "message": message_from_bytes(raw, policy=compat32),
+                       "modseq": self.modseq, "internaldate": Time2Internaldate(time()).strip('"'), "appended": time()}
+            self.uidnext += 1
+            self.messages.append(message)
+            count = len(self.messages)
+            idlers = list(self.idlers)
+        for idler in idlers:
+            idler.push(f"* {count} EXISTS\r\n".encode())
+        return message["uid"]
+
+class _Handler(StreamRequestHandler):
+    """one imap connection"""
+    def push(self, data) -> None:
+        """send data to the client"""
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def handle(self):
+        self.write_lock = Lock()
+        self.mailbox = None
+        self.idle_tag = None
+        self.push(b"* OK benchmark imap server ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode().rstrip("\r\n")
+            if line == "DONE" and self.idle_tag is not None:
+                with self.mailbox.lock:
+                    self.mailbox.idlers.remove(self)
+                self.push(f"{self.idle_tag} OK IDLE terminated\r\n".encode())
+                self.idle_tag = None
+                continue
+            tag, _, rest = line.partition(" ")
+            command, _, arguments = rest.partition(" ")
+            uid = command.upper() == "UID"
+            if uid:
+                command, _, arguments = arguments.partition(" ")
+            handler = getattr(self, "command_" + command.lower(), None)
+            if handler is None:
+                self.push(f"{tag} BAD unknown command\r\n".encode())
+            elif handler(tag, arguments, uid) is False:
+                return
+
+    def command_capability(self, tag, arguments, uid):
+        self.push(f"* CAPABILITY {' '.join(self.server.capabilities)}\r\n{tag} OK done\r\n".encode())
+
+    def command_login(self, tag, arguments, uid):
+        self.push(f"{tag} OK logged in\r\n".encode())
+
+    def command_enable(self, tag, arguments, uid):
+        self.push(f"* ENABLED {arguments}\r\n{tag} OK enabled\r\n".encode())
+
+    def command_noop(self, tag, arguments, uid):
+        # like a server with CONDSTORE, the highest modseq of the selected mailbox is reported on every NOOP
+        response = f"* OK [HIGHESTMODSEQ {self.mailbox.modseq}] ok\r\n" if self.mailbox is not None else ""
+        self.push((response + f"{tag} OK noop\r\n").encode())
+
+    def command_logout(self, tag, arguments, uid):
+        self.push(f"* BYE bye\r\n{tag} OK logout\r\n".encode())
+        return False
+
+    def command_select(self, tag, arguments, uid):
+        self.mailbox = self.server.mailbox(arguments.split(" ")[0].strip('"'))
+        response = (f"* {len(self.mailbox.messages)} EXISTS\r\n* OK [UIDVALIDITY {self.mailbox.uidvalidity}] ok\r\n"
+                    f"* OK [UIDNEXT {self.mailbox.uidnext}] ok\r\n* OK [HIGHESTMODSEQ {self.mailbox.modseq}] ok\r\n")
+        self.push((response + f"{tag} OK [READ-WRITE] selected\r\n").encode())
+
+    def command_status(self, tag, arguments, uid):
+        name, _, items = arguments.partition(" ")
+        mailbox = self.server.mailbox(name.strip('"'))
+        with mailbox.lock:
+            values = {"MESSAGES": len(mailbox.messages), "UIDNEXT": mailbox.uidnext, "UIDVALIDITY": mailbox.uidvalidity,
+                      "UNSEEN": sum(1 for message in mailbox.messages if "\\Seen" not in message["flags"]), "HIGHESTMODSEQ": mailbox.modseq}
+        response = " ".join(f"{item} {values[item]}" for item in items.strip("()").upper().split() if item in values)
+        self.push(f"* STATUS {name} ({response})\r\n{tag} OK status completed\r\n".encode())
+
+    def command_idle(self, tag, arguments, uid):
+        self.idle_tag = tag
+        self.push(b"+ idling\r\n")
+        with self.mailbox.lock:
+            self.mailbox.idlers.append(self)
+
+    def __messages(self, message_set, uid) -> list:
+        """return (sequence number, message) of a message set"""
+        with self.mailbox.lock:
+            messages = list(enumerate(self.mailbox.messages, start=1))
+        maximum = messages[-1][1]["uid"] if uid and messages else len(messages)
+        return [(number, message) for number, message in messages if _in_set(message["uid"] if uid else number, message_set, maximum)]
+
+    def command_search(self, tag, arguments, uid):
+        # supports the criteria used by the reader: UNSEEN, FROM, UID, MODSEQ, OR and parentheses
+        tokens = findall(r'"(?:[^"\\]|\\.)*"|\(|\)|[^\s()]+', arguments)
+        messages = self.__messages("1:*", True)
+        maximum = messages[-1][1]["uid"] if messages else 0
+
+        def criterion():
+            token = tokens.pop(0)
+            upper = token.upper()
+            if token == "(":
+                criteria = []
+                while tokens[0] != ")":
+                    criteria.append(criterion())
+                tokens.pop(0)
+                return lambda message: all(check(message) for check in criteria)
+            if upper == "OR":
+                left, right = criterion(), criterion()
+                return lambda message: left(message) or right(message)
+            if upper == "UNSEEN":
+                return lambda message: "\\Seen" not in message["flags"]
+            if upper == "FROM":
+                needle = tokens.pop(0).strip('"').lower()
+                return lambda message: needle in (message["message"].get("From") or "").lower()
+            if upper == "UID":
+                message_set = tokens.pop(0)
+                return lambda message: _in_set(message["uid"], message_set, maximum)
+            if upper == "MODSEQ":
+                modseq = int(tokens.pop(0))
+                return lambda message: message["modseq"] >= modseq
+            return lambda message: True
+
+        criteria = []
+        while tokens:
+            criteria.append(criterion())
+        found = [message for _, message in messages if all(check(message) for check in criteria)]
+        values = [str(message["uid"]) for message in found]
+        if "MODSEQ" in arguments.upper() and found:
+            values.append(f"(MODSEQ {max(message['modseq'] for message in found)})")
+        self.push(f"* SEARCH {' '.join(values)}\r\n{tag} OK search\r\n".encode())
+
+    def command_fetch(self, tag, arguments, uid):
+        message_set, _, items = arguments.partition(" ")
+        items = findall(r'[^\s()]+(?:\[[^\]]*\](?:<[^>]*>)?)?', items)
+        for number, message in self.__messages(message_set, uid):
+            fields = [] if "UID" in (item.upper() for item in items) else [f"UID {message['uid']}".encode()]
+            for item in items:
+                upper = item.upper()
+                if upper == "UID":
+                    fields.append(f"UID {message['uid']}".encode())
+                elif upper == "BODYSTRUCTURE":
+                    fields.append(b"BODYSTRUCTURE " + _bodystructure(message["message"]).encode())
+                elif upper == "ENVELOPE":
+                    fields.append(b"ENVELOPE " + _envelope(message["message"]).encode())
+                elif upper == "INTERNALDATE":
+                    fields.append(f'INTERNALDATE "{message["internaldate"]}"'.encode())
+                elif upper.startswith("BODY"):
+                    peek, section, offset, length = match(r"BODY(\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?", item, I).groups()
+                    data = _section(message["message"], section) if section else message["raw"]
+                    if offset is not None:
+                        data = data[int(offset):int(offset) + int(length)]
+                    if not peek:
+                        message["flags"].add("\\Seen")
+                    self.server.bytes_sent += len(data)
+                    origin = f"<{offset}>" if offset is not None else ""
+                    fields.append(f"BODY[{section}]{origin} {{{len(data)}}}\r\n".encode() + data)
+            self.push(f"* {number} FETCH (".encode() + b" ".join(fields) + b")\r\n")
+        self.push(f"{tag} OK fetch\r\n".encode())
+
+    def command_store(self, tag, arguments, uid):
+        message_set, _, rest = arguments.partition(" ")
+        mode, _, flags = rest.partition(" ")
+        flags = flags.strip("()").split()
+        for number, message in self.__messages(message_set, uid):
+            with self.mailbox.lock:
+                if mode.upper().startswith("+FLAGS"):
+                    message["flags"].update(flags)
+                else:
+                    message["flags"].difference_update(flags)
+                self.mailbox.modseq += 1
+                message["modseq"] = self.mailbox.modseq
+            if not mode.upper().endswith(".SILENT"):
+                self.push(f"* {number} FETCH (UID {message['uid']} FLAGS ({' '.join(sorted(message['flags']))}))\r\n".encode())
+        self.push(f"{tag} OK store\r\n".encode())
+
+class ImapServer(ThreadingTCPServer):
+    """in-process imap server on a free local port which answers the commands used by the reader"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, capabilities=("IMAP4rev1", "IDLE", "CONDSTORE", "ENABLE")):
+        ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), _Handler)
+        self.capabilities = capabilities
+        self.mailboxes = {}
+        self.bytes_sent = 0
+        self.thread = Thread(target=self.serve_forever, name="benchmark-imap", daemon=True)
+        self.thread.start()
+
+    def mailbox(self, name="Inbox") -> Mailbox:
+        """return a mailbox, create it if necessary"""
+        return self.mailboxes.setdefault(name, Mailbox())
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def close(self) -> None:
+        """stop the server"""
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,184 @@
+"""mailAttachmentPrinter benchmark
+
+drives the real reader, printer and tides code against an in-process imap server and a recording cups stand-in
+and writes the results as json, e.g. from the repository root: python -m benchmarks.run --mails 500 --output result.json"""
+from argparse import ArgumentParser
+from copy import deepcopy
+from datetime import datetime,timedelta
+from importlib.util import find_spec
+from json import dump,dumps
+from logging import WARNING
+from os import mkdir
+from os.path import join
+from platform import python_version
+from random import Random
+from resource import getrusage,RUSAGE_SELF
+from sys import exit,modules,stdout
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from . import cups
+# core imports cups lazily, the stand-in has to be in place before
+modules['cups'] = cups
+
+from core import config as core_config,pipeline,printer,reader,tides
+from core.config import LOGGER,get_config,get_mailboxes
+from core.jobs import _percentiles
+from .data import make_mail,make_tide_files,mail_number
+from .imap import ImapServer
+
+def __range(text) -> tuple:
+    """parse a number or a range like 1-3"""
+    low, _, high = text.partition("-")
+    return int(low), int(high or low)
+
+def __arguments():
+    """parse the command line"""
+    parser = ArgumentParser(description="Benchmark fetching and printing mail attachments and rendering tide overviews.")
+    parser.add_argument("--mails", type=int, default=200, help="new mails per round (default: 200)")
+    parser.add_argument("--rounds", type=int, default=3, help="scans, each with new mails (default: 3)")
+    parser.add_argument("--attachments", type=__range, default=(1, 1), help="pdf attachments per mail, e.g. 1-3 (default: 1)")
+    parser.add_argument("--size", type=__range, default=(20 * 1024, 200 * 1024), help="attachment size in bytes, e.g. 1000-50000 (default: 20480-204800)")
+    parser.add_argument("--images", type=int, default=0, help="inline images per mail, which are not printed (default: 0)")
+    parser.add_argument("--backend", choices=core_config.PRINTER_BACKENDS, default="file", help="printer backend (default: file)")
+    parser.add_argument("--workers", type=int, default=2, help="print workers (default: 2)")
+    parser.add_argument("--batch", action="store_true", help="print the attachments of a scan as one job")
+    parser.add_argument("--batch-size", type=int, default=50, help="mails fetched with one command (default: 50)")
+    parser.add_argument("--tide-renders", type=int, default=10, help="tide overviews rendered, 0 to skip the tide benchmark (default: 10)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic data (default: 1)")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    return parser.parse_args()
+
+def __configuration(directory, server, arguments) -> dict:
+    """load a configuration file for the benchmark through the regular config validation"""
+    configuration = {
+        "imap": {"batch_size": arguments.batch_size, "credentials": {"password": "benchmark", "username": "benchmark"},
+                 "force_ssl": False, "port": server.port, "server": "127.0.0.1"},
+        "log": {"level": WARNING},
+        "printer": {"backend": arguments.backend, "batch": {"enabled": arguments.batch}, "name": cups.PRINTERS[0], "server": "localhost",
+                    "workers": arguments.workers},
+        "scan_interval": 10,
+        "tide": {"enabled": False}
+    }
+    core_config.CONFIG_FILE = join(directory, "config.json")
+    with open(core_config.CONFIG_FILE, "w") as config_file:
+        dump(configuration, config_file)
+    return get_config()
+
+def benchmark_mails(configuration, server, arguments, random) -> dict:
+    """scan rounds of new mails and measure throughput and the latency from the start of a scan to the submission of each mail"""
+    mailbox_configuration = get_mailboxes(configuration)[0]
+    mailbox = server.mailbox("Inbox")
+    printer.set_server(configuration)
+    printer.set_backend(configuration)
+
+    rounds = []
+    latencies = []
+    for _ in range(arguments.rounds):
+        first = len(mailbox.messages)
+        for number in range(first, first + arguments.mails):
+            sizes = [random.randint(*arguments.size) for _ in range(random.randint(*arguments.attachments))]
+            mailbox.append(make_mail(number, sizes, arguments.images))
+        cups.reset()
+        fetched = server.bytes_sent
+        started = perf_counter()
+        found = reader.read_email(mailbox_configuration)
+        seconds = perf_counter() - started
+
+        # a mail is printed once cups received its last attachment
+        printed = {}
+        for received, document in cups.documents():
+            printed[mail_number(document)] = max(printed.get(mail_number(document), 0), received - started)
+        round_result = {"mails": found, "printed_mails": len(printed), "documents": len(cups.documents()), "jobs": len(cups.JOBS), "seconds": seconds,
+                        "messages_per_second": found / seconds if seconds else None, "imap_bytes": server.bytes_sent - fetched}
+        # e.g. read_email returns 0 after an imap error, such a round measures nothing
+        if found != arguments.mails or len(printed) != arguments.mails:
+            round_result["error"] = f"found {found} and printed {len(printed)} of {arguments.mails} new mails"
+        else:
+            latencies += printed.values()
+        rounds.append(round_result)
+    pipeline.shutdown()
+
+    throughputs = sorted(round_result["messages_per_second"] for round_result in rounds if "error" not in round_result)
+    result = {"rounds": rounds, "messages_per_second": throughputs[len(throughputs) // 2] if throughputs else None,
+              "latency_seconds": _percentiles(latencies)}
+    failed = sum(1 for round_result in rounds if "error" in round_result)
+    if failed:
+        result["error"] = f"{failed} of {len(rounds)} rounds did not print all new mails"
+    return result
+
+def benchmark_tides(configuration, directory, arguments, random) -> dict:
+    """measure indexing synthetic tide files and rendering overviews in the render worker"""
+    missing = [module for module in ("markdown2", "weasyprint") if find_spec(module) is None]
+    if missing:
+        return {"skipped": f"not installed: {', '.join(missing)}"}
+    from core.render import shutdown as render_shutdown
+
+    tides.TIDES_DIRECTORY = join(directory, "tides")
+    mkdir(tides.TIDES_DIRECTORY)
+    make_tide_files(tides.TIDES_DIRECTORY, random)
+    configuration = deepcopy(configuration)
+    configuration["tide"].update({"enabled": True, "stations": ["DE__505P"]})
+
+    result = {}
+    started = perf_counter()
+    tides._combine_data(configuration)
+    result["index_seconds"] = perf_counter() - started
+    started = perf_counter()
+    tides._combine_data(configuration)
+    result["indexed_seconds"] = perf_counter() - started
+    tides.start_render_worker()
+
+    # the first render waits for the warm-up of the render worker
+    renders = []
+    current_time = datetime(2026, 6, 1, 8).astimezone()
+    try:
+        for _ in range(arguments.tide_renders):
+            # every overview is rendered, none is taken from the cache
+            tides._RENDER_CACHE.clear()
+            started = perf_counter()
+            tides._get_overview(configuration, current_time)
+            renders.append(perf_counter() - started)
+            current_time += timedelta(hours=7)
+    except (RuntimeError, OSError) as exception:
+        # e.g. weasyprint is installed without its system libraries
+        result["error"] = f"could not render tide overview: {exception}"
+    finally:
+        render_shutdown()
+    if renders:
+        result["first_render_seconds"] = renders.pop(0)
+    result["render_seconds"] = _percentiles(renders)
+    return result
+
+def main() -> None:
+    """run the benchmarks and write the results"""
+    arguments = __arguments()
+    random = Random(arguments.seed)
+    parameters = dict(vars(arguments), attachments="-".join(map(str, arguments.attachments)), size="-".join(map(str, arguments.size)))
+    result = {"python": python_version(), "parameters": parameters}
+
+    server = ImapServer()
+    try:
+        with TemporaryDirectory() as directory:
+            # checkpoints of the benchmark mailbox are not kept
+            reader.CHECKPOINT_FILE = join(directory, "checkpoints.json")
+            configuration = __configuration(directory, server, arguments)
+            LOGGER.setLevel(WARNING)
+            result["mails"] = benchmark_mails(configuration, server, arguments, random)
+            if arguments.tide_renders > 0:
+                result["tides"] = benchmark_tides(configuration, directory, arguments, random)
+    finally:
+        server.close()
+    # linux reports the peak resident memory in KiB
+    result["peak_rss_bytes"] = getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+    if arguments.output:
+        with open(arguments.output, "w") as output_file:
+            dump(result, output_file, indent=2)
+    else:
+        stdout.write(dumps(result, indent=2) + "\n")
+    if "error" in result["mails"]:
+        exit(f"Benchmark failed: {result['mails']['error']}")
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,120 @@
 """mailAttachmentPrinter core"""
 from copy import deepcopy
-from schedule import every,run_pending
 from sys import exit
-from time import sleep
+from time import perf_counter
 from json import dumps
+from signal import signal,SIGTERM
+from logging import DEBUG,INFO
 
-from .config import get_config,LOGGER
-from .printer import get_printers,try_connection as printer_try_connection,set_server as printer_set_server
-from .reader import read_email,try_connection as reader_try_connection
+from .config import get_config,get_mailboxes,LOGGER
+from .engine import serve
+from .jobs import shutdown as jobs_shutdown
+from .journal import resume as journal_resume,shutdown as journal_shutdown
+from .metrics import start as metrics_start,shutdown as metrics_shutdown
+from .pipeline import start as pipeline_start,shutdown as pipeline_shutdown
+from .profiling import start as profiling_start,shutdown as profiling_shutdown
+from .printer import get_printers,try_connection as printer_try_connection,set_backend as printer_set_backend,set_server as printer_set_server
+from .reader import try_connection as reader_try_connection
 
-def main():
+def __timed(timings, phase, started) -> float:
+    """record the seconds since started for a startup phase and return the current time"""
+    now = perf_counter()
+    timings[phase] = now - started
+    return now
+
+def main(check_only=False):
     """main"""
+    timings = {}
+    started = perf_counter()
     configuration = get_config()
+    started = __timed(timings, "config", started)
 
     # check if connection to cups is possible
     printer_set_server(configuration)
+    printer_set_backend(configuration)
     printer_try_connection()
+    started = __timed(timings, "cups", started)
+
+    # check if connection to imap server is possible for every mailbox
+    for mailbox_configuration in get_mailboxes(configuration):
+        reader_try_connection(mailbox_configuration)
+    started = __timed(timings, "imap", started)
 
-    # check if connection to imap server is possible
-    reader_try_connection(configuration)
-
-    # check if printer name is empty
-    printers = get_printers()
-    if configuration['printer']['name'] == "" or configuration['printer']['name'] not in printers:
-        LOGGER.critical("Error with Printers!")
-        print('Please set up a printer_name from the available names:')
-        print(printers)
-        print('Please set the \'$.printer.name\' in config.json or the environment variable: \'PRINTER_NAME\'')
-        exit(-1)
+    # check if every mailbox has at least one printer of its pool, missing pool members are skipped while printing
+    printers = {}
+    for mailbox in get_mailboxes(configuration):
+        available = []
+        for printer in mailbox['printer']['pool']:
+            if printer['server'] not in printers:
+                try:
+                    printers[printer['server']] = get_printers(printer['server'])
+                except RuntimeError as exception:
+                    LOGGER.warning("Could not connect to cups printer server %s: %s", printer['server'], exception)
+                    printers[printer['server']] = []
+            if printer['name'] != "" and printer['name'] in printers[printer['server']]:
+                available.append(printer['name'])
+            else:
+                LOGGER.warning("Printer '%s' is not available on %s", printer['name'], printer['server'])
+        if available == []:
+            LOGGER.critical("Error with Printers!")
+            print('Please set up a printer_name from the available names:')
+            print(printers)
+            print('Please set the \'$.printer.name\' (or \'$.printer.pool\', \'$.accounts[].mailboxes[].printer\') in config.json or the environment variable: \'PRINTER_NAME\'')
+            exit(-1)
     LOGGER.debug("Configured printer in cups printer server list")
+    started = __timed(timings, "printers", started)
 
     # check tide requirements if enabled
     if configuration["tide"]["enabled"]:
         from .tides import check_requirements
         check_requirements(configuration)
+        started = __timed(timings, "tides", started)
+
+    for phase, seconds in timings.items():
+        LOGGER.log(INFO if check_only else DEBUG, "Startup phase '%s' took %.3f s", phase, seconds)
+    if check_only:
+        LOGGER.info("Configuration and requirements are valid.")
+        return
 
     # print config
     LOGGER.info("Running with the following configuration:")
     print_configuration = deepcopy(configuration)
-    print_configuration['imap']['credentials']['password'] = "******"
+    for account in print_configuration['accounts']:
+        account['credentials']['password'] = "******"
+    if 'credentials' in print_configuration['imap']:
+        print_configuration['imap']['credentials']['password'] = "******"
     LOGGER.info(dumps(print_configuration, indent=2))
 
-    # run main program
-    every(int(configuration['scan_interval'])).seconds.do(lambda: read_email(configuration))
+    # pre-render tide overviews, so printing them after an attachment does not wait for the layout
+    if configuration["tide"]["enabled"]:
+        from .tides import start_prerender,start_render_worker
+        start_render_worker()
+        start_prerender(configuration)
 
-    LOGGER.info('MailPrinter is now running...')
+    metrics_start(configuration)
+    # profile and trace allocations on request, nothing is recorded until then
+    profiling_start(configuration)
+    # start print workers, queued jobs are printed before the program stops
+    pipeline_start(configuration)
+    signal(SIGTERM, lambda signum, frame: exit(0))
+    try:
+        # attachments which were spooled before a restart are printed without fetching them again
+        journal_resume(configuration)
+        __run(configuration)
+    finally:
+        pipeline_shutdown()
+        # the journal is closed first, so jobs which are still tracked are tracked again after the restart
+        journal_shutdown()
+        jobs_shutdown()
+        metrics_shutdown()
+        profiling_shutdown()
+        if configuration["tide"]["enabled"]:
+            from .render import shutdown as render_shutdown
+            from .tides import stop_prerender
+            stop_prerender()
+            render_shutdown()
 
-    while True:
-        run_pending()
-        sleep(1)
+def __run(configuration):
+    """run main program"""
+    # all mailboxes of all accounts are served by one event loop
+    serve(configuration)
@@ -3,6 +3,7 @@ from json import load
 from os import environ,mkdir
 from os.path import exists,dirname,realpath,isdir,join
 from pytz import timezone
+from struct import Struct
 from sys import exit,stderr
 from logging import getLogger,INFO,StreamHandler,Formatter
 
@@ -14,8 +15,34 @@ CONFIG_FILE = join(CONFIG_DIRECTORY, "config.json")
 TIDES_DELIMITER = "#"
 TIDES_DIRECTORY = join(APP_DIRECTORY, "tides")
 TIDES_ENCODING = "iso 8859-1"
+TIDES_INDEX_HEADER = Struct("<8sqqII")  # magic, source mtime in ns, source size, event count, meta data length
+TIDES_INDEX_MAGIC = b"MAPTIDX1"
+TIDES_INDEX_SUFFIX = ".idx"
+TIDES_PRERENDER_LEAD = 60  # seconds before the next tide event or midnight the following overview is rendered
+TIDES_RENDER_CACHE_SIZE = 4
+TIDES_SCAN_WORKERS = 8  # tide files whose headers are read at the same time on startup
 TIDES_TIMEZONE = timezone("Etc/GMT-1")
 TMP_DIRECTORY = join(APP_DIRECTORY, "tmp")
+CHECKPOINT_FILE = join(TMP_DIRECTORY, "checkpoints.json")
+DEDUP_FILE = join(TMP_DIRECTORY, "dedup.json")
+JOURNAL_FILE = join(TMP_DIRECTORY, "journal.log")
+SPOOL_DIRECTORY = join(TMP_DIRECTORY, "spool")
+IMAP_IDLE_TIMEOUT = 25 * 60  # re-issue IDLE well before the 29 minutes servers may drop idle clients
+IMAP_KEEPALIVE_INTERVAL = 5 * 60  # send NOOP on connections which were not used for this many seconds
+IMAP_RECONNECT_MAX_BACKOFF = 5 * 60  # upper limit in seconds for the exponential reconnect backoff
+JOBS_LATENCY_SAMPLES = 1000  # completed jobs the latency distribution is computed from
+JOBS_STATISTICS_INTERVAL = 15 * 60  # seconds between two logged print job statistics
+JOURNAL_COMPACT_RECORDS = 1000  # the journal is compacted after this many appended records
+JOURNAL_SYNC_INTERVAL = 1  # seconds between two batched syncs of the journal to disk
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)  # upper bounds of the histogram buckets in seconds
+PRINTER_BACKENDS = ["file", "stream"]
+PRINTER_STATUS_CACHE_SECONDS = 5  # queue lengths and states of a cups server are queried at most this often
+PRINTER_STREAM_CHUNK_SIZE = 64 * 1024
+PROFILING_TOP = 25  # allocations listed per section of an allocation report
+PROFILING_TRACE_FRAMES = 25  # frames stored per traced allocation
+RENDER_WORKER_MAX_RENDERS = 100  # restart the render worker after this many renders
+RENDER_WORKER_MAX_RSS = 512 * 1024 * 1024  # restart the render worker if its resident memory grew above this many bytes
+SCAN_JITTER = 0.1  # scan intervals vary randomly by this fraction, so several instances do not scan in sync
 
 _LOGGER_HANDLER = StreamHandler()
 _LOGGER_HANDLER.setFormatter(Formatter("%(asctime)s - %(levelname)s - %(message)s"))
@@ -36,17 +63,94 @@ def __load_config_file() -> dict:
             config = load(config_file)
 
             # Check if config and values are in proper format
-            assert config['imap']['credentials']['password'] != "" and type(config['imap']['credentials']['password']) == str, "'$.imap.credentials.password' is not a string or empty."
-            assert config['imap']['credentials']['username'] != "" and type(config['imap']['credentials']['username']) == str, "'$.imap.credentials.username' is not a string or empty."
-            assert type(config['imap']['force_ssl']) == bool, "'$.printer.name' is not a Bool."
-            assert type(config['imap']['port']) == int, "'$.imap.port' is not a integer."
-            assert config['imap']['server'] != "" and type(config['imap']['server']) == str, "'$.imap.server' is not a string or empty."
+            if 'accounts' in config:
+                assert type(config['accounts']) == list and config['accounts'] != [], "'$.accounts' is not a list or empty."
+                for number, account in enumerate(config['accounts']):
+                    assert account['credentials']['password'] != "" and type(account['credentials']['password']) == str, f"'$.accounts[{number}].credentials.password' is not a string or empty."
+                    assert account['credentials']['username'] != "" and type(account['credentials']['username']) == str, f"'$.accounts[{number}].credentials.username' is not a string or empty."
+                    assert type(account.get('force_ssl', True)) == bool, f"'$.accounts[{number}].force_ssl' is not a bool."
+                    assert type(account['port']) == int, f"'$.accounts[{number}].port' is not a integer."
+                    assert account['server'] != "" and type(account['server']) == str, f"'$.accounts[{number}].server' is not a string or empty."
+                    assert type(account.get('concurrency', 1)) == int and account.get('concurrency', 1) > 0, f"'$.accounts[{number}].concurrency' is not a positive integer."
+                    assert type(account.get('from_address', "")) == str, f"'$.accounts[{number}].from_address' is not a string."
+                    assert type(account.get('printer', "")) == str, f"'$.accounts[{number}].printer' is not a string."
+                    assert type(account.get('mailboxes', [])) == list, f"'$.accounts[{number}].mailboxes' is not a list."
+                    for mailbox in account.get('mailboxes', []):
+                        assert type(mailbox['name']) == str and mailbox['name'] != "", f"'$.accounts[{number}].mailboxes[].name' is not a string or empty."
+                        assert type(mailbox.get('from_address', "")) == str, f"'$.accounts[{number}].mailboxes[].from_address' is not a string."
+                        assert type(mailbox.get('printer', "")) == str, f"'$.accounts[{number}].mailboxes[].printer' is not a string."
+                # the imap block only holds settings shared by all accounts
+                config.setdefault('imap', {})
+            else:
+                assert config['imap']['credentials']['password'] != "" and type(config['imap']['credentials']['password']) == str, "'$.imap.credentials.password' is not a string or empty."
+                assert config['imap']['credentials']['username'] != "" and type(config['imap']['credentials']['username']) == str, "'$.imap.credentials.username' is not a string or empty."
+                assert type(config['imap']['force_ssl']) == bool, "'$.printer.name' is not a Bool."
+                assert type(config['imap']['port']) == int, "'$.imap.port' is not a integer."
+                assert config['imap']['server'] != "" and type(config['imap']['server']) == str, "'$.imap.server' is not a string or empty."
+            if 'dedup' in config:
+                assert type(config['dedup']['enabled']) == bool, "'$.dedup.enabled' is not a bool."
+                assert type(config['dedup'].get('ttl', 0)) == int, "'$.dedup.ttl' is not a integer."
+                assert type(config['dedup'].get('max_entries', 0)) == int, "'$.dedup.max_entries' is not a integer."
+            if 'journal' in config:
+                assert type(config['journal']['enabled']) == bool, "'$.journal.enabled' is not a bool."
+            if 'metrics' in config:
+                assert type(config['metrics']['enabled']) == bool, "'$.metrics.enabled' is not a bool."
+                assert type(config['metrics'].get('address', "")) == str, "'$.metrics.address' is not a string."
+                assert type(config['metrics'].get('port', 0)) == int and 0 <= config['metrics'].get('port', 0) < 65536, "'$.metrics.port' is not a port."
+            if 'profiling' in config:
+                assert type(config['profiling'].get('scans', 1)) == int and config['profiling'].get('scans', 1) > 0, "'$.profiling.scans' is not a positive integer."
+                assert type(config['profiling'].get('socket', "")) == str, "'$.profiling.socket' is not a string."
+            if 'idle' in config['imap']:
+                assert type(config['imap']['idle']) == bool, "'$.imap.idle' is not a bool."
+            if 'fetch_chunk_size' in config['imap']:
+                assert type(config['imap']['fetch_chunk_size']) == int and config['imap']['fetch_chunk_size'] > 0, "'$.imap.fetch_chunk_size' is not a positive integer."
+            if 'spool_threshold' in config['imap']:
+                assert type(config['imap']['spool_threshold']) == int and config['imap']['spool_threshold'] >= 0, "'$.imap.spool_threshold' is not a integer."
+            if 'batch_size' in config['imap']:
+                assert type(config['imap']['batch_size']) == int and config['imap']['batch_size'] > 0, "'$.imap.batch_size' is not a positive integer."
+            if 'mailboxes' in config['imap']:
+                assert config['imap']['mailboxes'] != [] and type(config['imap']['mailboxes']) == list, "'$.imap.mailboxes' is not a list or empty."
             assert type(config['printer']['name']) == str, "'$.printer.name' is not a string."
-            assert config['printer']['server'] != "" and type(config['imap']['server']) == str, "'$.printer.server' is not a string or empty."
+            assert config['printer']['server'] != "" and type(config['printer']['server']) == str, "'$.printer.server' is not a string or empty."
+            if 'backend' in config['printer']:
+                assert config['printer']['backend'] in PRINTER_BACKENDS, f"'$.printer.backend' is not one of {PRINTER_BACKENDS}."
+            if 'batch' in config['printer']:
+                assert type(config['printer']['batch']['enabled']) == bool, "'$.printer.batch.enabled' is not a bool."
+                assert type(config['printer']['batch'].get('max_bytes', 1)) == int and config['printer']['batch'].get('max_bytes', 1) > 0, "'$.printer.batch.max_bytes' is not a positive integer."
+                assert type(config['printer']['batch'].get('max_documents', 1)) == int and config['printer']['batch'].get('max_documents', 1) > 0, "'$.printer.batch.max_documents' is not a positive integer."
+            if 'workers' in config['printer']:
+                assert type(config['printer']['workers']) == int and config['printer']['workers'] > 0, "'$.printer.workers' is not a positive integer."
+            if 'pool' in config['printer']:
+                assert config['printer']['pool'] != [] and type(config['printer']['pool']) == list, "'$.printer.pool' is not a list or empty."
+                for printer in config['printer']['pool']:
+                    assert type(printer['name']) == str and printer['name'] != "", "'$.printer.pool[].name' is not a string or empty."
+                    assert type(printer.get('server', "")) == str, "'$.printer.pool[].server' is not a string."
+            if 'routes' in config['printer']:
+                assert type(config['printer']['routes']) == list, "'$.printer.routes' is not a list."
+                pool_names = [printer['name'] for printer in config['printer'].get('pool', [{"name": config['printer']['name']}])]
+                for route in config['printer']['routes']:
+                    assert type(route['from_address']) == str and route['from_address'] != "", "'$.printer.routes[].from_address' is not a string or empty."
+                    assert type(route['printers']) == list and all(printer in pool_names for printer in route['printers']), "'$.printer.routes[].printers' is not a list of printers of '$.printer.pool'."
+            if 'queue_size' in config['printer']:
+                assert type(config['printer']['queue_size']) == int and config['printer']['queue_size'] > 0, "'$.printer.queue_size' is not a positive integer."
             assert type(config['scan_interval']) == int, "'$.scan_interval' is not a integer."
+            if 'scan_burst_interval' in config:
+                assert type(config['scan_burst_interval']) == int and config['scan_burst_interval'] >= 0, "'$.scan_burst_interval' is not a integer."
+            if 'scan_max_interval' in config:
+                assert type(config['scan_max_interval']) == int and config['scan_max_interval'] >= config['scan_interval'], "'$.scan_max_interval' is not a integer of at least '$.scan_interval'."
+            if 'tracking' in config:
+                assert type(config['tracking']['enabled']) == bool, "'$.tracking.enabled' is not a bool."
+                assert type(config['tracking'].get('interval', 1)) == int and config['tracking'].get('interval', 1) > 0, "'$.tracking.interval' is not a positive integer."
+                assert type(config['tracking'].get('max_retries', 0)) == int and config['tracking'].get('max_retries', 0) >= 0, "'$.tracking.max_retries' is not a integer."
+                assert type(config['tracking'].get('seen_on_completion', False)) == bool, "'$.tracking.seen_on_completion' is not a bool."
+                assert type(config['tracking'].get('timeout', 1)) == int and config['tracking'].get('timeout', 1) > 0, "'$.tracking.timeout' is not a positive integer."
             assert type(config['tide']['enabled']) == bool, "'$.tide.enabled' is not a bool."
             if config['tide']['enabled']:
                 assert config['tide']['stations'] != [] and type(config['tide']['stations']) == list, "'$.tide.stations' is not a list or empty."
+            if 'previous_events' in config['tide']:
+                assert type(config['tide']['previous_events']) == int and config['tide']['previous_events'] >= 0, "'$.tide.previous_events' is not a integer."
+            if 'next_events' in config['tide']:
+                assert type(config['tide']['next_events']) == int and config['tide']['next_events'] >= 0, "'$.tide.next_events' is not a integer."
 
             return config
         # give detailed error messages
@@ -74,6 +178,7 @@ def __load_environment_variables() -> dict:
         assert environ.get("IMAP_CREDENTIALS_USERNAME") != "" and environ.get("IMAP_CREDENTIALS_USERNAME") != None, "Environment variable 'IMAP_CREDENTIALS_USERNAME' is not a set or empty."
         assert environ.get("IMAP_SERVER") != "" and environ.get("IMAP_SERVER") != None, "Environment variable 'IMAP_SERVER' is not a set or empty."
         assert environ.get("PRINTER_SERVER") != "" and environ.get("PRINTER_SERVER") != None, "Environment variable 'PRINTER_SERVER' is not a set or empty."
+        assert environ.get("PRINTER_BACKEND", default="file").lower() in PRINTER_BACKENDS, f"Environment variable 'PRINTER_BACKEND' is not one of {PRINTER_BACKENDS}."
         if environ.get("TIDE_ENABLED", default="False").lower() in TRUE_VALUES:
             assert environ.get("TIDE_STATIONS") != "" and environ.get("TIDE_STATIONS") != None, "Environment variable 'TIDE_STATIONS' is not a set or empty."
     # give detailed error messages
@@ -83,25 +188,69 @@ def __load_environment_variables() -> dict:
         exit(-1)
 
     config = {
+        "dedup": {
+            "enabled": environ.get("DEDUP_ENABLED", default="False").lower() in TRUE_VALUES,
+            "max_entries": int(environ.get("DEDUP_MAX_ENTRIES", default=10000)),
+            "ttl": int(environ.get("DEDUP_TTL", default=24 * 60 * 60))
+        },
         "imap": {
+            "batch_size": int(environ.get("IMAP_BATCH_SIZE", default=50)),
             "credentials": {
                 "password": environ.get("IMAP_CREDENTIALS_PASSWORD"),
                 "username": environ.get("IMAP_CREDENTIALS_USERNAME")
             },
+            "fetch_chunk_size": int(environ.get("IMAP_FETCH_CHUNK_SIZE", default=1024 * 1024)),
             "force_ssl": environ.get("IMAP_FORCE_SSL", default="True").lower() in TRUE_VALUES,
+            "idle": environ.get("IMAP_IDLE", default="False").lower() in TRUE_VALUES,
+            "mailboxes": environ.get("IMAP_MAILBOXES", default="Inbox").split(","),
             "port": int(environ.get("IMAP_PORT", default=993)),
-            "server": environ.get("IMAP_SERVER")
+            "server": environ.get("IMAP_SERVER"),
+            "spool_threshold": int(environ.get("IMAP_SPOOL_THRESHOLD", default=1024 * 1024))
+        },
+        "journal": {
+            "enabled": environ.get("JOURNAL_ENABLED", default="False").lower() in TRUE_VALUES
+        },
+        "metrics": {
+            "address": environ.get("METRICS_ADDRESS", default="127.0.0.1"),
+            "enabled": environ.get("METRICS_ENABLED", default="False").lower() in TRUE_VALUES,
+            "port": int(environ.get("METRICS_PORT", default=9464))
         },
         "printer": {
+            "backend": environ.get("PRINTER_BACKEND", default="file").lower(),
+            "batch": {
+                "enabled": environ.get("PRINTER_BATCH_ENABLED", default="False").lower() in TRUE_VALUES,
+                "max_bytes": int(environ.get("PRINTER_BATCH_MAX_BYTES", default=50 * 1024 * 1024)),
+                "max_documents": int(environ.get("PRINTER_BATCH_MAX_DOCUMENTS", default=50))
+            },
             "name": environ.get("PRINTER_NAME", default=""),
-            "server": environ.get("PRINTER_SERVER")
+            "queue_size": int(environ.get("PRINTER_QUEUE_SIZE", default=10)),
+            "server": environ.get("PRINTER_SERVER"),
+            "workers": int(environ.get("PRINTER_WORKERS", default=2))
         },
+        "profiling": {
+            "scans": int(environ.get("PROFILING_SCANS", default=5)),
+            "socket": environ.get("PROFILING_SOCKET", default="")
+        },
+        "scan_burst_interval": int(environ.get("SCAN_BURST_INTERVAL", default=1)),
         "scan_interval": int(environ.get("SCAN_INTERVAL", default=10)),
+        "scan_max_interval": int(environ.get("SCAN_MAX_INTERVAL", default=environ.get("SCAN_INTERVAL", default=10))),
         "tide": {
-            "enabled": environ.get("TIDE_ENABLED", default="False").lower() in TRUE_VALUES
+            "enabled": environ.get("TIDE_ENABLED", default="False").lower() in TRUE_VALUES,
+            "next_events": int(environ.get("TIDE_NEXT_EVENTS", default=2)),
+            "previous_events": int(environ.get("TIDE_PREVIOUS_EVENTS", default=2))
+        },
+        "tracking": {
+            "enabled": environ.get("TRACKING_ENABLED", default="False").lower() in TRUE_VALUES,
+            "interval": int(environ.get("TRACKING_INTERVAL", default=5)),
+            "max_retries": int(environ.get("TRACKING_MAX_RETRIES", default=2)),
+            "seen_on_completion": environ.get("TRACKING_SEEN_ON_COMPLETION", default="False").lower() in TRUE_VALUES,
+            "timeout": int(environ.get("TRACKING_TIMEOUT", default=60 * 60))
         }
     }
 
+    if environ.get("PRINTER_POOL") != None:
+        # printer or printer@server
+        config["printer"]["pool"] = [dict(zip(["name", "server"], printer.split("@", 1))) for printer in environ.get("PRINTER_POOL").split(",")]
     if environ.get("IMAP_FROM_ADDRESS") != None:
         config["imap"]["from_address"] = environ.get("IMAP_FROM_ADDRESS")
     if environ.get("LOG_LEVEL") != None:
@@ -112,6 +261,75 @@ def __load_environment_variables() -> dict:
 
     return config
 
+def __set_defaults(config) -> None:
+    """set default values for optional configuration entries"""
+    # a single imap block is the only account
+    if 'accounts' not in config:
+        imap = config['imap']
+        config['accounts'] = [{"server": imap['server'], "port": imap['port'], "force_ssl": imap['force_ssl'], "credentials": imap['credentials'],
+                               "mailboxes": [{"name": mailbox} for mailbox in imap.get('mailboxes', ["Inbox"])]}]
+    for account in config['accounts']:
+        account.setdefault('concurrency', 1)
+        account.setdefault('force_ssl', True)
+        account.setdefault('mailboxes', [{"name": "Inbox"}])
+    config.setdefault('dedup', {'enabled': False})
+    config['dedup'].setdefault('max_entries', 10000)
+    config['dedup'].setdefault('ttl', 24 * 60 * 60)
+    config['imap'].setdefault('batch_size', 50)
+    config['imap'].setdefault('fetch_chunk_size', 1024 * 1024)
+    config['imap'].setdefault('idle', False)
+    config['imap'].setdefault('spool_threshold', 1024 * 1024)
+    config.setdefault('journal', {'enabled': False})
+    config.setdefault('metrics', {'enabled': False})
+    config['metrics'].setdefault('address', "127.0.0.1")
+    config['metrics'].setdefault('port', 9464)
+    config['printer'].setdefault('backend', "file")
+    config['printer'].setdefault('batch', {'enabled': False})
+    config['printer']['batch'].setdefault('max_bytes', 50 * 1024 * 1024)
+    config['printer']['batch'].setdefault('max_documents', 50)
+    # a single printer is a pool of one
+    config['printer'].setdefault('pool', [{"name": config['printer']['name']}])
+    for printer in config['printer']['pool']:
+        printer.setdefault('server', config['printer']['server'])
+    config['printer'].setdefault('queue_size', 10)
+    config['printer'].setdefault('workers', 2)
+    config.setdefault('profiling', {})
+    config['profiling'].setdefault('scans', 5)
+    config['profiling'].setdefault('socket', "")
+    config.setdefault('scan_burst_interval', 1)
+    # without a maximum the interval is not increased while mailboxes stay empty
+    config.setdefault('scan_max_interval', config['scan_interval'])
+    config['tide'].setdefault('next_events', 2)
+    config['tide'].setdefault('previous_events', 2)
+    config.setdefault('tracking', {'enabled': False})
+    config['tracking'].setdefault('interval', 5)
+    config['tracking'].setdefault('max_retries', 2)
+    config['tracking'].setdefault('seen_on_completion', False)
+    config['tracking'].setdefault('timeout', 60 * 60)
+
+def get_mailboxes(config) -> list:
+    """return one configuration per mailbox of all accounts, with the account's imap settings and the mailbox's printer"""
+    mailboxes = []
+    for number, account in enumerate(config['accounts']):
+        for mailbox in account['mailboxes']:
+            imap = dict(config['imap'])
+            imap.update({"server": account['server'], "port": account['port'], "force_ssl": account['force_ssl'],
+                         "credentials": account['credentials'], "mailbox": mailbox['name']})
+            # a filter of the mailbox replaces the one of the account and of the imap block
+            for source in (account, mailbox):
+                if 'from_address' in source:
+                    imap['from_address'] = source['from_address']
+            printer = dict(config['printer'])
+            for source in (account, mailbox):
+                if 'printer' in source:
+                    printer['name'] = source['printer']
+                    printer['pool'] = [{"name": source['printer'], "server": printer['server']}]
+                    printer['routes'] = []
+            mailbox_config = dict(config)
+            mailbox_config.update({"imap": imap, "printer": printer, "account": number})
+            mailboxes.append(mailbox_config)
+    return mailboxes
+
 def _set_log_level(config) -> None:
     """Set Log Level"""
     try:
@@ -142,6 +360,7 @@ def get_config() -> dict:
     if config == {}:
         config = __load_environment_variables()
 
+    __set_defaults(config)
     _set_log_level(config)
     __check_directories(config)
 
@@ -0,0 +1,74 @@
+"""mailAttachmentPrinter dedup"""
+from collections import OrderedDict
+from json import dump,load
+from os import replace
+from os.path import exists
+from threading import Lock
+from time import time
+
+from .config import LOGGER,DEDUP_FILE
+
+class DedupCache:
+    """persistent cache of printed attachment hashes with ttl and lru size limit"""
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.changed = False
+        # digest -> time of the print, least recently used first
+        self.entries = OrderedDict()
+        if exists(path):
+            try:
+                with open(path, 'r') as dedup_file:
+                    self.entries.update(load(dedup_file))
+            except (OSError, ValueError) as exception:
+                LOGGER.warning("Could not load dedup cache, starting empty: %s", exception)
+
+    def check_and_add(self, digest) -> bool:
+        """return True if the digest was printed within the ttl, otherwise remember it"""
+        with self.lock:
+            now = time()
+            printed = self.entries.get(digest)
+            if printed is not None and now - printed < self.ttl:
+                self.entries.move_to_end(digest)
+                return True
+            self.entries[digest] = now
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.changed = True
+            return False
+
+    def discard(self, digest) -> None:
+        """forget a digest, e.g. because its print failed"""
+        with self.lock:
+            if self.entries.pop(digest, None) is not None:
+                self.changed = True
+
+    def save(self) -> None:
+        """persist the cache, expired entries are dropped"""
+        with self.lock:
+            if not self.changed:
+                return
+            now = time()
+            for digest in [digest for digest, printed in self.entries.items() if now - printed >= self.ttl]:
+                del self.entries[digest]
+            # write to a temporary file first, so a crash never leaves a truncated cache file
+            with open(self.path + ".tmp", 'w') as dedup_file:
+                dump(self.entries, dedup_file)
+            replace(self.path + ".tmp", self.path)
+            self.changed = False
+
+_CACHE = None
+_CACHE_LOCK = Lock()
+
+def get_cache(configuration):
+    """return the dedup cache, None if dedup is disabled"""
+    global _CACHE
+    if not configuration['dedup']['enabled']:
+        return None
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = DedupCache(DEDUP_FILE, configuration['dedup']['ttl'], configuration['dedup']['max_entries'])
+        return _CACHE
@@ -0,0 +1,93 @@
+"""mailAttachmentPrinter engine"""
+from asyncio import Semaphore,gather,get_running_loop,run,sleep
+from concurrent.futures import ThreadPoolExecutor
+from imaplib import IMAP4
+from random import uniform
+
+from .config import LOGGER,IMAP_KEEPALIVE_INTERVAL,SCAN_JITTER,get_mailboxes
+from .reader import abort_sessions,keepalive_sessions,read_email,wait_email
+
+class ScanSchedule:
+    """interval between two scans of a mailbox, short while mails keep arriving and growing exponentially while the mailbox stays empty"""
+    def __init__(self, interval, burst_interval, max_interval, jitter=SCAN_JITTER):
+        self.interval = interval
+        self.burst_interval = min(burst_interval, interval)
+        self.max_interval = max(max_interval, interval)
+        self.jitter = jitter
+        self.current = interval
+
+    def next(self, new_mails) -> float:
+        """return the seconds until the next scan after a scan which found a number of new mails"""
+        if new_mails:
+            # more mails of a burst are likely to follow right away
+            self.current = self.burst_interval
+        elif self.current < self.interval:
+            self.current = self.interval
+        else:
+            self.current = min(self.current * 2, self.max_interval)
+        return self.current * uniform(1 - self.jitter, 1 + self.jitter)
+
+async def __scan(executor, semaphore, configuration) -> int:
+    """scan a mailbox, at most the account's concurrency limit of its mailboxes at once, return the number of new mails"""
+    async with semaphore:
+        try:
+            return await get_running_loop().run_in_executor(executor, read_email, configuration)
+        except Exception as exception:
+            # an unexpected error of one mailbox must not stop the others, the mailbox is scanned again on its schedule
+            LOGGER.exception("Error while scanning mailbox '%s': %s", configuration['imap'].get('mailbox', 'Inbox'), exception)
+            return 0
+
+async def __serve_mailbox(executor, semaphore, configuration):
+    """scan a mailbox when the server announces new mails (idle) or on the adaptive scan schedule"""
+    idle = configuration['imap']['idle']
+    schedule = ScanSchedule(configuration['scan_interval'], configuration['scan_burst_interval'], configuration['scan_max_interval'])
+    loop = get_running_loop()
+    # the first scans of several instances or mailboxes are spread as well
+    await sleep(uniform(0, SCAN_JITTER * configuration['scan_interval']))
+    started = loop.time()
+    new_mails = await __scan(executor, semaphore, configuration)
+    while True:
+        if idle:
+            try:
+                announced = await loop.run_in_executor(executor, wait_email, configuration)
+            except (IMAP4.error, OSError) as exception:
+                LOGGER.error("Lost connection to imap server: %s", exception)
+                await sleep(int(configuration['scan_interval']))
+                announced = True
+            except Exception as exception:
+                LOGGER.exception("Error while waiting for new mails: %s", exception)
+                await sleep(int(configuration['scan_interval']))
+                announced = True
+            if announced is None:
+                idle = False
+                continue
+            if not announced:
+                continue
+        else:
+            # the deadline counts from the start of the last scan, so slow scans do not stretch the interval
+            await sleep(max(0, started + schedule.next(new_mails) - loop.time()))
+        started = loop.time()
+        new_mails = await __scan(executor, semaphore, configuration)
+
+async def __keepalive(executor):
+    """send NOOP on sessions which were not used for a while"""
+    while True:
+        await sleep(IMAP_KEEPALIVE_INTERVAL)
+        await get_running_loop().run_in_executor(executor, keepalive_sessions)
+
+async def __serve(configuration):
+    """serve all mailboxes of all accounts until cancelled"""
+    mailboxes = get_mailboxes(configuration)
+    # imaplib blocks, every mailbox gets a thread so a mailbox in IDLE never delays the others
+    executor = ThreadPoolExecutor(max_workers=len(mailboxes) + 1, thread_name_prefix="imap")
+    semaphores = [Semaphore(account['concurrency']) for account in configuration['accounts']]
+    try:
+        await gather(__keepalive(executor), *[__serve_mailbox(executor, semaphores[mailbox['account']], mailbox) for mailbox in mailboxes])
+    finally:
+        abort_sessions()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def serve(configuration) -> None:
+    """run the event loop which serves all mailboxes"""
+    LOGGER.info('MailPrinter is now running for %d mailboxes...', len(get_mailboxes(configuration)))
+    run(__serve(configuration))
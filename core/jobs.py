@@ -0,0 +1,200 @@
+"""mailAttachmentPrinter jobs"""
+from collections import deque
+from concurrent.futures import Future
+from threading import Event,Lock,Thread
+from time import monotonic,time
+
+from .config import LOGGER,JOBS_LATENCY_SAMPLES,JOBS_STATISTICS_INTERVAL
+from .metrics import gauge,increment,observe
+from .printer import cancel_job,get_jobs,print_documents,select_printer
+
+class PrintJob:
+    """a submitted cups job together with everything needed to submit it again"""
+    def __init__(self, documents, candidates, printer, server, job_id, arrival=None):
+        # several documents if attachments were printed as one job
+        self.documents = documents
+        self.candidates = candidates
+        self.printer = printer
+        self.server = server
+        self.job_id = job_id
+        self.arrival = arrival
+        self.submitted = monotonic()
+        self.first_submitted = self.submitted
+        self.attempts = 1
+        # resolved once the job completed or finally failed
+        self.future = Future()
+
+    def close(self) -> None:
+        """release the spooled documents"""
+        for document in self.documents:
+            if hasattr(document, 'close'):
+                document.close()
+
+def _percentiles(samples) -> dict:
+    """return p50, p90, p99 and max of samples"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    result = {f"p{percent}": ordered[min(len(ordered) - 1, len(ordered) * percent // 100)] for percent in (50, 90, 99)}
+    result["max"] = ordered[-1]
+    return result
+
+class JobTracker:
+    """tracks submitted jobs to completion with one query per cups server and interval, failed jobs are submitted again"""
+    def __init__(self, interval, max_retries, timeout):
+        self.interval = interval
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.lock = Lock()
+        # (server, job id) -> PrintJob
+        self.jobs = {}
+        self.counters = {"completed": 0, "failed": 0, "resubmitted": 0}
+        # seconds from submission to completion and from mail arrival to completion
+        self.completion_seconds = deque(maxlen=JOBS_LATENCY_SAMPLES)
+        self.end_to_end_seconds = deque(maxlen=JOBS_LATENCY_SAMPLES)
+        gauge("print_jobs_tracked", lambda: len(self.jobs))
+        self.stop = Event()
+        self.thread = Thread(target=self.__run, name="print-tracker", daemon=True)
+        self.thread.start()
+
+    def track(self, job) -> Future:
+        """start tracking a submitted job, the documents of a job which is already tracked are added to it"""
+        with self.lock:
+            tracked = self.jobs.setdefault((job.server, job.job_id), job)
+            if tracked is not job:
+                # the attachments of a batch are tracked again one by one after a restart
+                tracked.documents += job.documents
+        return tracked.future
+
+    def __run(self):
+        """poll the job states until stopped"""
+        last_statistics = monotonic()
+        while not self.stop.wait(self.interval):
+            self.poll()
+            if monotonic() - last_statistics >= JOBS_STATISTICS_INTERVAL:
+                last_statistics = monotonic()
+                LOGGER.info("Print jobs: %s", self.statistics())
+
+    def poll(self) -> None:
+        """query the not completed jobs of every server with tracked jobs once and resolve the finished ones"""
+        import cups
+        with self.lock:
+            servers = {}
+            for (server, job_id), job in self.jobs.items():
+                servers.setdefault(server, {})[job_id] = job
+        for server, jobs in servers.items():
+            try:
+                active = get_jobs(server)
+                finished = [job_id for job_id in jobs if job_id not in active]
+                # the final state of finished jobs is only queried if there are any
+                states = get_jobs(server, 'completed', min(finished)) if finished else {}
+            except Exception as exception:
+                LOGGER.warning("Could not query print jobs on %s: %s", server, exception)
+                continue
+            for job_id, job in jobs.items():
+                if job_id in active:
+                    state = active[job_id].get('job-state')
+                    if state == cups.IPP_JOB_STOPPED:
+                        self.__failed(job, "stopped")
+                    elif monotonic() - job.submitted > self.timeout:
+                        self.__failed(job, "held" if state == cups.IPP_JOB_HELD else "timed out")
+                    continue
+                # jobs purged from the history are assumed to be completed
+                state = states.get(job_id, {}).get('job-state', cups.IPP_JOB_COMPLETED)
+                if state == cups.IPP_JOB_COMPLETED:
+                    self.__completed(job)
+                else:
+                    self.__failed(job, "canceled or aborted")
+
+    def __completed(self, job):
+        """record the latency of a completed job and resolve it"""
+        with self.lock:
+            self.jobs.pop((job.server, job.job_id), None)
+            self.counters["completed"] += 1
+            self.completion_seconds.append(monotonic() - job.first_submitted)
+            if job.arrival is not None:
+                self.end_to_end_seconds.append(time() - job.arrival)
+        increment("print_jobs_total", result="completed")
+        observe("print_job_completion_seconds", monotonic() - job.first_submitted)
+        if job.arrival is not None:
+            observe("print_job_end_to_end_seconds", time() - job.arrival)
+        LOGGER.debug("Print job %s on '%s' completed after %.1fs", job.job_id, job.printer, monotonic() - job.first_submitted)
+        job.close()
+        job.future.set_result(True)
+
+    def __failed(self, job, reason):
+        """submit a failed job again, or give up after the retry limit"""
+        with self.lock:
+            self.jobs.pop((job.server, job.job_id), None)
+        try:
+            cancel_job(job.job_id, job.server)
+        except Exception:
+            pass
+        if job.attempts <= self.max_retries:
+            LOGGER.warning("Print job %s on '%s' %s, submitting it again", job.job_id, job.printer, reason)
+            try:
+                job.printer, job.server = select_printer(job.candidates)
+                for document in job.documents:
+                    if hasattr(document, 'seek'):
+                        document.seek(0)
+                job.job_id = print_documents(job.documents, job.printer, job.server)
+            except Exception as exception:
+                LOGGER.error("Could not submit print job again: %s", exception)
+            else:
+                job.attempts += 1
+                job.submitted = monotonic()
+                with self.lock:
+                    self.counters["resubmitted"] += 1
+                    self.jobs[(job.server, job.job_id)] = job
+                increment("print_jobs_total", result="resubmitted")
+                return
+        LOGGER.error("Print job %s on '%s' %s, giving up after %d attempts", job.job_id, job.printer, reason, job.attempts)
+        with self.lock:
+            self.counters["failed"] += 1
+        increment("print_jobs_total", result="failed")
+        job.close()
+        job.future.set_exception(RuntimeError(f"print job {job.job_id} on '{job.printer}' {reason}"))
+
+    def statistics(self) -> dict:
+        """return the job counters and the distribution of the time to completion in seconds"""
+        with self.lock:
+            return dict(self.counters, tracked=len(self.jobs), completion_seconds=_percentiles(self.completion_seconds),
+                        end_to_end_seconds=_percentiles(self.end_to_end_seconds))
+
+    def shutdown(self):
+        """stop tracking, jobs which are still tracked are left to cups"""
+        self.stop.set()
+        self.thread.join()
+        with self.lock:
+            jobs = list(self.jobs.values())
+            self.jobs.clear()
+        for job in jobs:
+            job.close()
+            job.future.set_exception(RuntimeError(f"print job {job.job_id} was not completed before shutdown"))
+
+_TRACKER = None
+_TRACKER_LOCK = Lock()
+
+def start(configuration):
+    """start the job tracker if tracking is enabled and it is not running yet, return None if disabled"""
+    global _TRACKER
+    if not configuration['tracking']['enabled']:
+        return None
+    with _TRACKER_LOCK:
+        if _TRACKER is None:
+            tracking = configuration['tracking']
+            _TRACKER = JobTracker(tracking['interval'], tracking['max_retries'], tracking['timeout'])
+        return _TRACKER
+
+def statistics() -> dict:
+    """return the statistics of the job tracker, empty if it is not running"""
+    with _TRACKER_LOCK:
+        return _TRACKER.statistics() if _TRACKER is not None else {}
+
+def shutdown() -> None:
+    """stop the job tracker"""
+    global _TRACKER
+    with _TRACKER_LOCK:
+        if _TRACKER is not None:
+            _TRACKER.shutdown()
+            _TRACKER = None
@@ -0,0 +1,327 @@
+"""mailAttachmentPrinter journal"""
+from hashlib import sha256
+from json import dumps,loads
+from os import close,fsync,listdir,mkdir,remove,replace
+from os.path import exists,isdir,join
+from tempfile import mkstemp
+from threading import Event,Lock,Thread
+
+from .config import LOGGER,JOURNAL_COMPACT_RECORDS,JOURNAL_FILE,JOURNAL_SYNC_INTERVAL,SPOOL_DIRECTORY,get_mailboxes
+from .jobs import PrintJob,start as tracker_start
+from .pipeline import submit
+from .printer import get_candidates
+
+def mailbox_key(configuration) -> str:
+    """return the key of a mailbox, used for the sync checkpoints and the journal"""
+    imap = configuration['imap']
+    return f"{imap['credentials']['username']}@{imap['server']}:{imap['port']}/{imap.get('mailbox', 'Inbox')}"
+
+class Journal:
+    """append-only journal of the mails between fetching and printing, their attachments are kept in spool files
+
+    every attachment is spooled, submitted and completed, a mail is acknowledged once it is flagged as seen.
+    records are appended without waiting for the disk, a background thread syncs them in batches."""
+    def __init__(self, path, spool_directory):
+        self.path = path
+        self.spool_directory = spool_directory
+        self.lock = Lock()
+        # mail key -> {"mailbox", "uidvalidity", "uid", "sender", "arrival", "acknowledged", "failed", "attachments"}
+        self.mails = {}
+        self.records = 0
+        self.compacted_records = 0
+        self.dirty = False
+        # spool files written since the last sync
+        self.unsynced = []
+        if not isdir(spool_directory):
+            mkdir(spool_directory)
+        self.file = None
+        self.__load()
+        self.__compact()
+        self.__remove_orphans()
+        self.stop = Event()
+        self.thread = Thread(target=self.__sync_periodically, name="journal-sync", daemon=True)
+        self.thread.start()
+
+    def __load(self) -> None:
+        """replay the journal file, a record which was cut off by a crash ends the replay"""
+        if not exists(self.path):
+            return
+        with open(self.path, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    self.__apply(loads(line))
+                except (ValueError, KeyError, IndexError):
+                    LOGGER.warning("Journal ends with an incomplete record, ignoring it")
+                    break
+        LOGGER.debug("Loaded journal with %d unfinished mails", len(self.mails))
+
+    def __apply(self, record) -> None:
+        """apply a record to the state of its mail"""
+        key, state = record['mail'], record['state']
+        if state == "fetched":
+            self.mails[key] = {"mailbox": record['mailbox'], "uidvalidity": record['uidvalidity'], "uid": record['uid'],
+                               "sender": record['sender'], "arrival": record['arrival'], "acknowledged": False, "failed": False,
+                               "attachments": [None] * record['attachments']}
+            return
+        mail = self.mails.get(key)
+        if mail is None:
+            return
+        if state == "spooled":
+            mail['attachments'][record['attachment']] = {"state": state, "path": record['path'], "digest": record['digest']}
+        elif state == "submitted":
+            mail['attachments'][record['attachment']].update(state=state, job_id=record['job_id'], printer=record['printer'], server=record['server'])
+        elif state == "completed":
+            mail['attachments'][record['attachment']]['state'] = state
+        elif state == "acknowledged":
+            mail['acknowledged'] = True
+        elif state == "failed":
+            mail['failed'] = True
+
+    def __append(self, records) -> None:
+        """apply records and append them to the journal file, they are written to disk with the next sync"""
+        with self.lock:
+            # jobs which fail because the program stops are not recorded after the journal was closed
+            if self.file is None:
+                return
+            for record in records:
+                self.__apply(record)
+                self.file.write(dumps(record) + "\n")
+            # the spool files of finished mails are removed right away, compacting only rewrites the journal
+            for key in {record['mail'] for record in records}:
+                mail = self.mails.get(key)
+                if mail is not None and self.__finished(mail):
+                    self.__remove_spool_files(mail)
+            self.records += len(records)
+            self.dirty = True
+            if self.records - self.compacted_records > JOURNAL_COMPACT_RECORDS:
+                self.__compact()
+
+    @staticmethod
+    def __printed(mail) -> bool:
+        """return True if all attachments of a mail completed"""
+        return all(attachment is not None and attachment['state'] == "completed" for attachment in mail['attachments'])
+
+    @classmethod
+    def __finished(cls, mail) -> bool:
+        """return True if a mail failed, or was printed and flagged as seen, so its spool files are not needed anymore"""
+        return mail['failed'] or (mail['acknowledged'] and cls.__printed(mail))
+
+    @staticmethod
+    def __remove_spool_files(mail) -> None:
+        """remove the spool files of the attachments of a mail"""
+        for attachment in mail['attachments']:
+            if attachment is not None and exists(attachment['path']):
+                remove(attachment['path'])
+
+    def __compact(self) -> None:
+        """rewrite the journal with the records of the unfinished mails only"""
+        for key in [key for key, mail in self.mails.items() if self.__finished(mail)]:
+            # e.g. finished mails of a journal which was written before a crash
+            self.__remove_spool_files(self.mails.pop(key))
+
+        records = []
+        for key, mail in self.mails.items():
+            records.append({"mail": key, "state": "fetched", "mailbox": mail['mailbox'], "uidvalidity": mail['uidvalidity'], "uid": mail['uid'],
+                            "sender": mail['sender'], "arrival": mail['arrival'], "attachments": len(mail['attachments'])})
+            for number, attachment in enumerate(mail['attachments']):
+                if attachment is None:
+                    continue
+                records.append({"mail": key, "state": "spooled", "attachment": number, "path": attachment['path'], "digest": attachment['digest']})
+                if 'job_id' in attachment:
+                    records.append({"mail": key, "state": "submitted", "attachment": number, "job_id": attachment['job_id'],
+                                    "printer": attachment['printer'], "server": attachment['server']})
+                if attachment['state'] == "completed":
+                    records.append({"mail": key, "state": "completed", "attachment": number})
+            if mail['acknowledged']:
+                records.append({"mail": key, "state": "acknowledged"})
+        # write to a temporary file first, so a crash never leaves a truncated journal
+        with open(self.path + ".tmp", 'w') as journal_file:
+            journal_file.write("".join(dumps(record) + "\n" for record in records))
+            journal_file.flush()
+            fsync(journal_file.fileno())
+        replace(self.path + ".tmp", self.path)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'a')
+        self.records = self.compacted_records = len(records)
+        self.dirty = False
+        LOGGER.debug("Compacted journal to %d records of %d mails", len(records), len(self.mails))
+
+    def __remove_orphans(self) -> None:
+        """remove spool files which were written before a crash but never recorded"""
+        known = {attachment['path'] for mail in self.mails.values() for attachment in mail['attachments'] if attachment is not None}
+        for name in listdir(self.spool_directory):
+            if join(self.spool_directory, name) not in known:
+                remove(join(self.spool_directory, name))
+
+    def sync(self) -> None:
+        """write the new spool files and the appended records to disk"""
+        with self.lock:
+            unsynced, self.unsynced = self.unsynced, []
+            dirty, self.dirty = self.dirty, False
+            self.file.flush()
+        # spool files first, so a synced record never refers to data which is not on disk
+        for path in unsynced:
+            try:
+                with open(path, 'rb') as spool_file:
+                    fsync(spool_file.fileno())
+            except FileNotFoundError:
+                pass
+        if dirty:
+            with self.lock:
+                fsync(self.file.fileno())
+
+    def __sync_periodically(self) -> None:
+        """sync all records appended within an interval at once"""
+        while not self.stop.wait(JOURNAL_SYNC_INTERVAL):
+            try:
+                self.sync()
+            except OSError as exception:
+                LOGGER.error("Could not sync journal: %s", exception)
+
+    def spool_file(self):
+        """return a new spool file opened for writing and reading"""
+        file_descriptor, path = mkstemp(suffix=".pdf", dir=self.spool_directory)
+        close(file_descriptor)
+        return open(path, 'w+b')
+
+    def discard(self, document) -> None:
+        """close and remove a spool file which is not printed"""
+        document.close()
+        if exists(document.name):
+            remove(document.name)
+
+    def fetched(self, configuration, uidvalidity, uid, spooled, sender=None, arrival=None) -> list:
+        """record a fetched mail with its spooled attachments [(spool file, sha256)], return the keys of the attachments"""
+        key = f"{mailbox_key(configuration)}/{uidvalidity}/{uid}"
+        records = [{"mail": key, "state": "fetched", "mailbox": mailbox_key(configuration), "uidvalidity": uidvalidity, "uid": int(uid),
+                    "sender": sender, "arrival": arrival, "attachments": len(spooled)}]
+        for number, (document, digest) in enumerate(spooled):
+            document.flush()
+            records.append({"mail": key, "state": "spooled", "attachment": number, "path": document.name, "digest": digest})
+        with self.lock:
+            # the spool files of a mail which failed before are obsolete
+            if key in self.mails:
+                self.__remove_spool_files(self.mails.pop(key))
+            self.unsynced += [document.name for document, _ in spooled]
+        self.__append(records)
+        return [(key, number) for number in range(len(spooled))]
+
+    def follow(self, attachments, job) -> None:
+        """record the cups jobs of attachments as soon as the print job of their mail finished"""
+        job.add_done_callback(lambda future: self.failed(attachments[0][0]) if future.exception() is not None else self.track(attachments, future.result()))
+
+    def track(self, attachments, results) -> None:
+        """record the cups jobs [(job id, printer, server, completion)] of attachments and their completion"""
+        self.__append([{"mail": key, "state": "submitted", "attachment": number, "job_id": job_id, "printer": printer, "server": server}
+                       for (key, number), (job_id, printer, server, _) in zip(attachments, results)])
+        for attachment, (_, _, _, completion) in zip(attachments, results):
+            if completion is None:
+                # untracked jobs count as completed once cups accepted them
+                self.completed(attachment)
+            else:
+                completion.add_done_callback(lambda future, attachment=attachment:
+                                             self.failed(attachment[0]) if future.exception() is not None else self.completed(attachment))
+
+    def completed(self, attachment) -> None:
+        """record that the cups job of an attachment completed"""
+        key, number = attachment
+        self.__append([{"mail": key, "state": "completed", "attachment": number}])
+
+    def failed(self, key) -> None:
+        """record that a mail could not be printed, it is fetched again with the next scan"""
+        self.__append([{"mail": key, "state": "failed"}])
+
+    def acknowledged(self, configuration, uidvalidity, uids) -> None:
+        """record that mails were flagged as seen"""
+        with self.lock:
+            keys = [key for key in (f"{mailbox_key(configuration)}/{uidvalidity}/{uid}" for uid in uids) if key in self.mails]
+        self.__append([{"mail": key, "state": "acknowledged"} for key in keys])
+
+    def uids(self, configuration, uidvalidity) -> tuple:
+        """return the journaled uids of a mailbox as (uids which are still printing, uids which are printed but not flagged as seen)"""
+        printing, printed = [], []
+        with self.lock:
+            for mail in self.mails.values():
+                if mail['mailbox'] != mailbox_key(configuration) or mail['uidvalidity'] != uidvalidity or mail['failed'] or mail['acknowledged']:
+                    continue
+                (printed if self.__printed(mail) else printing).append(mail['uid'])
+        return printing, printed
+
+    def pending(self) -> list:
+        """return [(mail key, mail)] of the mails which were not printed completely"""
+        with self.lock:
+            return [(key, mail) for key, mail in self.mails.items() if not mail['failed'] and not self.__printed(mail)]
+
+    def close(self) -> None:
+        """sync and close the journal"""
+        self.stop.set()
+        self.thread.join()
+        self.sync()
+        with self.lock:
+            self.file.close()
+            self.file = None
+
+_JOURNAL = None
+_JOURNAL_LOCK = Lock()
+
+def _intact(attachment) -> bool:
+    """return True if the spool file of an attachment exists and has the recorded content"""
+    if attachment is None or not exists(attachment['path']):
+        return False
+    digest = sha256()
+    with open(attachment['path'], 'rb') as spool_file:
+        for chunk in iter(lambda: spool_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest() == attachment['digest']
+
+def get_journal(configuration):
+    """return the journal, None if it is disabled"""
+    global _JOURNAL
+    if not configuration['journal']['enabled']:
+        return None
+    with _JOURNAL_LOCK:
+        if _JOURNAL is None:
+            _JOURNAL = Journal(JOURNAL_FILE, SPOOL_DIRECTORY)
+        return _JOURNAL
+
+def resume(configuration) -> None:
+    """print the attachments of the journaled mails which were not printed completely from their spool files, without fetching them again"""
+    journal = get_journal(configuration)
+    if journal is None:
+        return
+    mailboxes = {mailbox_key(mailbox): mailbox for mailbox in get_mailboxes(configuration)}
+    for key, mail in journal.pending():
+        mailbox = mailboxes.get(mail['mailbox'])
+        if mailbox is None or not all(_intact(attachment) for attachment in mail['attachments']):
+            LOGGER.warning("Could not resume mail %s, it is fetched again", mail['uid'])
+            journal.failed(key)
+            continue
+
+        tracker = tracker_start(mailbox)
+        spooled = []
+        for number, attachment in enumerate(mail['attachments']):
+            if attachment['state'] == "spooled":
+                spooled.append((key, number))
+            elif attachment['state'] == "submitted":
+                # jobs which cups accepted before the restart are only tracked again
+                if tracker is not None and attachment['job_id'] is not None:
+                    job = PrintJob([open(attachment['path'], 'rb')], get_candidates(mailbox, mail['sender']), attachment['printer'],
+                                   attachment['server'], attachment['job_id'], mail['arrival'])
+                    journal.track([(key, number)], [(job.job_id, job.printer, job.server, tracker.track(job))])
+                else:
+                    journal.completed((key, number))
+        if not spooled:
+            continue
+
+        LOGGER.info("Resuming %d spooled attachments of mail %s", len(spooled), mail['uid'])
+        documents = [open(mail['attachments'][number]['path'], 'rb') for _, number in spooled]
+        journal.follow(spooled, submit(mailbox, documents, mail['sender'], mail['arrival']))
+
+def shutdown() -> None:
+    """sync and close the journal"""
+    global _JOURNAL
+    with _JOURNAL_LOCK:
+        if _JOURNAL is not None:
+            _JOURNAL.close()
+            _JOURNAL = None
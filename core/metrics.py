@@ -0,0 +1,138 @@
+"""mailAttachmentPrinter metrics"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock,Thread
+from time import perf_counter
+
+from .config import LOGGER,METRICS_BUCKETS
+
+# name -> (type, help), every metric is exported with the prefix
+_PREFIX = "mailprinter_"
+_METRICS = {
+    "attachments_total": ("counter", "Attachments by result: printed, skipped as duplicate or failed"),
+    "fetched_bytes_total": ("counter", "Encoded attachment bytes fetched from the imap servers"),
+    "mails_total": ("counter", "New mails found by scans"),
+    "print_job_completion_seconds": ("histogram", "Seconds from the first submission of a tracked print job to its completion"),
+    "print_job_end_to_end_seconds": ("histogram", "Seconds from the arrival of a mail to the completion of its print job"),
+    "print_jobs_total": ("counter", "Tracked print jobs by result: completed, failed or resubmitted"),
+    "print_jobs_tracked": ("gauge", "Print jobs which are tracked until they are completed"),
+    "print_queue_depth": ("gauge", "Mails, or batches of mails, waiting for a print worker"),
+    "stage_seconds": ("histogram", "Seconds spent per stage: connect, login, search, fetch, parse, scan, print and tide_render"),
+    "tide_overviews_total": ("counter", "Tide overviews by result: cached or rendered"),
+}
+
+_LOCK = Lock()
+# (name, labels) -> value for counters, (name, labels) -> [bucket counts, sum, count] for histograms
+_COUNTERS = {}
+_HISTOGRAMS = {}
+# name -> function which returns the current value
+_GAUGES = {}
+
+def increment(name, amount=1, **labels) -> None:
+    """increase a counter"""
+    key = (name, tuple(sorted(labels.items())))
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + amount
+
+def observe(name, value, **labels) -> None:
+    """add an observation to a histogram"""
+    key = (name, tuple(sorted(labels.items())))
+    with _LOCK:
+        histogram = _HISTOGRAMS.setdefault(key, [[0] * len(METRICS_BUCKETS), 0.0, 0])
+        position = bisect_left(METRICS_BUCKETS, value)
+        if position < len(METRICS_BUCKETS):
+            histogram[0][position] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+@contextmanager
+def timed(stage):
+    """observe the seconds spent in a stage"""
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        observe("stage_seconds", perf_counter() - started, stage=stage)
+
+def gauge(name, function) -> None:
+    """export the value returned by a function when the metrics are collected"""
+    with _LOCK:
+        _GAUGES[name] = function
+
+def __labels(labels, extra=()) -> str:
+    """format labels for the text format"""
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+def render() -> str:
+    """return all metrics in the prometheus text format"""
+    with _LOCK:
+        counters = dict(_COUNTERS)
+        histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in _HISTOGRAMS.items()}
+        gauges = dict(_GAUGES)
+
+    lines = []
+    for name, (kind, description) in _METRICS.items():
+        lines.append(f"# HELP {_PREFIX}{name} {description}")
+        lines.append(f"# TYPE {_PREFIX}{name} {kind}")
+        if kind == "counter":
+            lines += [f"{_PREFIX}{name}{__labels(labels)} {value}" for (metric, labels), value in sorted(counters.items()) if metric == name]
+        elif kind == "gauge" and name in gauges:
+            try:
+                lines.append(f"{_PREFIX}{name} {gauges[name]()}")
+            except Exception as exception:
+                LOGGER.debug("Could not collect %s: %s", name, exception)
+        elif kind == "histogram":
+            for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(METRICS_BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append(f"{_PREFIX}{name}_bucket{__labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{_PREFIX}{name}_bucket{__labels(labels, (('le', '+Inf'),))} {count}")
+                lines.append(f"{_PREFIX}{name}_sum{__labels(labels)} {total}")
+                lines.append(f"{_PREFIX}{name}_count{__labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+_SERVER = None
+
+def start(configuration) -> None:
+    """serve the metrics over http if enabled"""
+    global _SERVER
+    metrics = configuration['metrics']
+    if not metrics['enabled'] or _SERVER is not None:
+        return
+    # http.server is only imported if the metrics are served, it slows down the startup noticeably
+    from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """serves the metrics on /metrics"""
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            LOGGER.debug("Metrics request: " + format, *args)
+
+    _SERVER = ThreadingHTTPServer((metrics['address'], metrics['port']), MetricsHandler)
+    _SERVER.daemon_threads = True
+    Thread(target=_SERVER.serve_forever, name="metrics", daemon=True).start()
+    LOGGER.info("Serving metrics on http://%s:%d/metrics", metrics['address'], _SERVER.server_address[1])
+
+def shutdown() -> None:
+    """stop serving the metrics"""
+    global _SERVER
+    if _SERVER is not None:
+        _SERVER.shutdown()
+        _SERVER.server_close()
+        _SERVER = None
@@ -0,0 +1,233 @@
+"""mailAttachmentPrinter pipeline"""
+from concurrent.futures import Future
+from os import SEEK_END
+from queue import Queue
+from threading import Lock,Thread
+
+from .config import LOGGER
+from .jobs import PrintJob,start as tracker_start
+from .metrics import gauge
+from .printer import batch_supported,get_candidates,print_documents,print_pdf,select_printer
+from .profiling import profiled
+
+class PartiallyPrintedError(RuntimeError):
+    """some attachments of a mail were printed before one of them failed"""
+    def __init__(self, printed, exception):
+        RuntimeError.__init__(self, f"{exception} (after {printed} printed attachments)")
+        self.printed = printed
+
+def _close(documents) -> None:
+    """release spooled attachments"""
+    for document in documents:
+        if hasattr(document, 'close'):
+            document.close()
+
+def _size(document) -> int:
+    """return the size of an attachment in bytes"""
+    if not hasattr(document, 'seek'):
+        return len(document)
+    document.seek(0, SEEK_END)
+    size = document.tell()
+    document.seek(0)
+    return size
+
+class PrintPipeline:
+    """bounded queue of print jobs which are submitted to cups by a pool of print workers"""
+    def __init__(self, workers, queue_size, tracker=None):
+        self.queue = Queue(maxsize=queue_size)
+        gauge("print_queue_depth", self.queue.qsize)
+        self.tracker = tracker
+        self.workers = [Thread(target=self.__work, name=f"print-worker-{number}", daemon=True) for number in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def __work(self):
+        """print queued jobs until the stop marker is received"""
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                mails, candidates, configuration, batched = job
+                # (future, documents, arrival) of the mails which were not cancelled
+                mails = [mail for mail in mails if mail[0].set_running_or_notify_cancel()]
+                if not mails:
+                    continue
+                with profiled():
+                    try:
+                        # all attachments of a mail are printed by the same worker on the same printer to keep their order
+                        printer, server = select_printer(candidates)
+                        if batched and batch_supported(printer, server):
+                            self.__print_batch(mails, candidates, configuration, printer, server)
+                        else:
+                            self.__print_separately(mails, candidates, configuration, printer, server)
+                    except Exception as exception:
+                        # the mails whose attachments were submitted already keep their results
+                        for future, _, _ in mails:
+                            if not future.done():
+                                future.set_exception(exception)
+                    finally:
+                        # release spooled attachments which were not printed
+                        for _, documents, _ in mails:
+                            _close(documents)
+            finally:
+                self.queue.task_done()
+
+    def __track(self, documents, candidates, printer, server, job_id, arrival):
+        """hand printed documents to the tracker, which keeps them until the job completed to be able to submit it again, return the completion future or None"""
+        if self.tracker is not None and job_id is not None:
+            return self.tracker.track(PrintJob(documents, candidates, printer, server, job_id, arrival))
+        _close(documents)
+        return None
+
+    def __print_mail(self, documents, candidates, printer, server, arrival) -> list:
+        """print the attachments of a mail as one job each, return (job id, printer, server, completion future or None) per attachment"""
+        results = []
+        while documents:
+            document = documents.pop(0)
+            LOGGER.info("Printing mail attachment on '%s'", printer)
+            try:
+                job_id = print_pdf(document, printer, server)
+            except Exception as exception:
+                # the attachment is released with the ones which were not printed
+                documents.insert(0, document)
+                if results:
+                    raise PartiallyPrintedError(len(results), exception) from exception
+                raise
+            results.append((job_id, printer, server, self.__track([document], candidates, printer, server, job_id, arrival)))
+        return results
+
+    def __print_tide_overview(self, configuration, printer, server) -> None:
+        """print the tide overview after the attachments, the mails are printed even if it fails"""
+        from .tides import create_tide_overview
+        try:
+            create_tide_overview(configuration, printer, server)
+        except Exception as exception:
+            LOGGER.error("Error while printing the tide overview on '%s': %s", printer, exception)
+
+    def __print_batch(self, mails, candidates, configuration, printer, server) -> None:
+        """print the attachments of several mails, followed by the tide overview if enabled, as one job, and set the results of every mail"""
+        counts = [len(documents) for _, documents, _ in mails]
+        documents = [document for _, mail_documents, _ in mails for document in mail_documents]
+        if configuration is not None:
+            from .tides import get_tide_overview
+            try:
+                documents.append(get_tide_overview(configuration))
+            except Exception as exception:
+                LOGGER.error("Error while rendering the tide overview, printing the batch without it: %s", exception)
+        LOGGER.info("Printing %d attachments of %d mails as one job on '%s'", sum(counts), len(mails), printer)
+        try:
+            job_id = print_documents(documents, printer, server)
+        except ValueError as exception:
+            LOGGER.warning("%s, printing the attachments as jobs of their own", exception)
+            # the failed merge has read the spooled attachments
+            for document in documents:
+                if hasattr(document, 'seek'):
+                    document.seek(0)
+            # merging the attachments of a single mail would fail again, every attachment is printed on its own
+            self.__print_separately(mails, candidates, configuration, printer, server)
+            return
+        for _, mail_documents, _ in mails:
+            mail_documents.clear()
+        # the latency of a batch is the one of its earliest mail
+        arrivals = [arrival for _, _, arrival in mails if arrival is not None]
+        completion = self.__track(documents, candidates, printer, server, job_id, min(arrivals) if arrivals else None)
+        for (future, _, _), count in zip(mails, counts):
+            future.set_result([(job_id, printer, server, completion)] * count)
+
+    def __print_separately(self, mails, candidates, configuration, printer, server) -> None:
+        """print the attachments of every mail as one job each, followed by the tide overview if enabled, and set the result of every mail as soon as it is printed"""
+        for future, documents, arrival in mails:
+            try:
+                result = self.__print_mail(documents, candidates, printer, server, arrival)
+            except Exception as exception:
+                future.set_exception(exception)
+                continue
+            future.set_result(result)
+        if configuration is not None and any(future.exception() is None for future, _, _ in mails):
+            self.__print_tide_overview(configuration, printer, server)
+
+    def submit(self, documents, candidates, configuration=None, arrival=None) -> Future:
+        """queue the attachments of one mail for one of the candidate printers, blocks while the queue is full, results in (job id, printer, server, completion future or None) per attachment"""
+        future = Future()
+        self.queue.put(([(future, list(documents), arrival)], candidates, configuration, False))
+        return future
+
+    def submit_batch(self, mails, candidates, configuration=None) -> None:
+        """queue the attachments of several mails [(future, documents, arrival)] to be printed as one job, blocks while the queue is full"""
+        self.queue.put(([(future, list(documents), arrival) for future, documents, arrival in mails], candidates, configuration, True))
+
+    def shutdown(self):
+        """let the workers finish all queued jobs and stop them"""
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+class PrintBatch:
+    """gathers the mails of a scan and queues the attachments for the same printers as one job, capped by the number and size of the attachments"""
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self.max_documents = configuration['printer']['batch']['max_documents']
+        self.max_bytes = configuration['printer']['batch']['max_bytes']
+        # printers of a routing rule -> gathered mails for them
+        self.groups = {}
+
+    def add(self, documents, sender=None, arrival=None) -> Future:
+        """add the attachments of one mail, the mails gathered before are queued first if it would exceed a cap, results like submit"""
+        candidates = get_candidates(self.configuration, sender)
+        key = tuple((printer['name'], printer.get('server')) for printer in candidates)
+        size = sum(_size(document) for document in documents)
+        group = self.groups.get(key)
+        if group is not None and (group["documents"] + len(documents) > self.max_documents or group["bytes"] + size > self.max_bytes):
+            self.__queue(key)
+            group = None
+        if group is None:
+            # a mail above the caps is printed as a job of its own
+            group = self.groups[key] = {"candidates": candidates, "mails": [], "documents": 0, "bytes": 0}
+        future = Future()
+        group["mails"].append((future, documents, arrival))
+        group["documents"] += len(documents)
+        group["bytes"] += size
+        return future
+
+    def __queue(self, key) -> None:
+        """queue the mails gathered for some printers"""
+        group = self.groups.pop(key)
+        tide_configuration = self.configuration if self.configuration["tide"]["enabled"] else None
+        start(self.configuration).submit_batch(group["mails"], group["candidates"], tide_configuration)
+
+    def flush(self) -> None:
+        """queue all gathered mails"""
+        for key in list(self.groups):
+            self.__queue(key)
+
+_PIPELINE = None
+_PIPELINE_LOCK = Lock()
+
+def start(configuration) -> PrintPipeline:
+    """start the print workers if they are not running yet"""
+    global _PIPELINE
+    with _PIPELINE_LOCK:
+        if _PIPELINE is None:
+            LOGGER.debug("Starting %d print workers", configuration['printer']['workers'])
+            _PIPELINE = PrintPipeline(configuration['printer']['workers'], configuration['printer']['queue_size'], tracker_start(configuration))
+        return _PIPELINE
+
+def submit(configuration, documents, sender=None, arrival=None) -> Future:
+    """queue the attachments of one mail for printing, followed by the tide overview if enabled"""
+    tide_configuration = configuration if configuration["tide"]["enabled"] else None
+    return start(configuration).submit(documents, get_candidates(configuration, sender), tide_configuration, arrival)
+
+def new_batch(configuration):
+    """return a batch which gathers the mails of a scan if batching is enabled, otherwise None"""
+    return PrintBatch(configuration) if configuration['printer']['batch']['enabled'] else None
+
+def shutdown() -> None:
+    """print all queued jobs and stop the print workers"""
+    global _PIPELINE
+    with _PIPELINE_LOCK:
+        if _PIPELINE is not None:
+            LOGGER.info("Waiting for queued print jobs...")
+            _PIPELINE.shutdown()
+            _PIPELINE = None
@@ -1,51 +1,304 @@
 """mailAttachmentPrinter printer"""
+from io import BytesIO
 from os import remove
-from os.path import exists,join
+from shutil import copyfileobj
+from tempfile import mkstemp
 from sys import exit,stderr
 
-from cups import setServer,Connection
-from .config import LOGGER,TMP_DIRECTORY,PRINTER_ENABLE
+from threading import Lock,local
+from time import monotonic
+from fnmatch import fnmatch
+
+from .config import LOGGER,TMP_DIRECTORY,PRINTER_ENABLE,PRINTER_STATUS_CACHE_SECONDS,PRINTER_STREAM_CHUNK_SIZE
+from .metrics import timed
+
+_BACKEND = "file"
+_SERVER = None
+# cups connections are not thread safe, every print worker keeps its own per server
+_CONNECTIONS = local()
+# server -> (time of the query, {printer: status}), shared by all print workers
+_STATUS = {}
+_STATUS_LOCK = Lock()
+# (server, printer) -> whether the printer accepts jobs of several documents
+_MULTIPLE_DOCUMENTS = {}
 
 def set_server(configuration):
     """set server for cups"""
-    setServer(configuration['printer']['server'])
+    global _SERVER
+    _SERVER = configuration['printer']['server']
+    # cups is imported on first use, so a dry run does not pay for loading it
+    import cups
+    cups.setServer(configuration['printer']['server'])
+
+def __new_connection(server=None):
+    """open a connection to a cups server, the configured one by default"""
+    import cups
+    server = server or _SERVER
+    # the server set by setServer is only known to the thread which set it, print workers pass it explicitly
+    if server is None or server.startswith("/"):
+        return cups.Connection()
+    if server.count(":") == 1:
+        host, port = server.split(":")
+        return cups.Connection(host=host, port=int(port))
+    return cups.Connection(host=server)
+
+def set_backend(configuration):
+    """set how print jobs are submitted to cups"""
+    global _BACKEND
+    _BACKEND = configuration['printer']['backend']
 
-def __print_file(_file, printer, description=""):
+def __print_file(_file, printer, server=None, description=""):
     """print file"""
-    conn = Connection()
-    conn.printFile(printer, _file, description, {})
+    conn = __new_connection(server)
+    return conn.printFile(printer, _file, description, {})
+
+def __print_files(files, printer, server=None, description=""):
+    """print files as the documents of one job"""
+    conn = __new_connection(server)
+    return conn.printFiles(printer, files, description, {})
+
+def __connection(server=None):
+    """return the kept cups connection of the current thread to a server, create it if necessary"""
+    if not hasattr(_CONNECTIONS, 'connections'):
+        _CONNECTIONS.connections = {}
+    connection = _CONNECTIONS.connections.get(server)
+    if connection is None:
+        connection = _CONNECTIONS.connections[server] = __new_connection(server)
+    return connection
+
+def __drop_connection(server=None):
+    """forget the kept cups connection of the current thread to a server"""
+    getattr(_CONNECTIONS, 'connections', {}).pop(server, None)
+
+def __write_document(connection, pdf):
+    """stream pdf from memory or a file object to the started document"""
+    import cups
+    if hasattr(pdf, 'read'):
+        chunks = iter(lambda: pdf.read(PRINTER_STREAM_CHUNK_SIZE), b'')
+    else:
+        view = memoryview(pdf)
+        chunks = (view[offset:offset + PRINTER_STREAM_CHUNK_SIZE] for offset in range(0, len(view), PRINTER_STREAM_CHUNK_SIZE))
+    for chunk in chunks:
+        status = connection.writeRequestData(bytes(chunk), len(chunk))
+        if status != cups.HTTP_CONTINUE:
+            raise cups.HTTPError(status)
+
+def __stream_file(pdfs, printer, server=None, description=""):
+    """print pdfs as the documents of one job over the kept cups connection without writing spool files"""
+    import cups
+    for attempt in range(2):
+        connection = __connection(server)
+        try:
+            job_id = connection.createJob(printer, description, {})
+        except (RuntimeError, cups.IPPError, cups.HTTPError):
+            # the kept connection may have been closed by the server, retry once on a new one
+            __drop_connection(server)
+            if attempt:
+                raise
+            continue
+        try:
+            for number, pdf in enumerate(pdfs):
+                connection.startDocument(printer, job_id, description, 'application/pdf', int(number == len(pdfs) - 1))
+                __write_document(connection, pdf)
+                connection.finishDocument(printer)
+            return job_id
+        except (RuntimeError, cups.IPPError, cups.HTTPError):
+            __drop_connection(server)
+            # do not leave an incomplete job in the queue
+            try:
+                __connection(server).cancelJob(job_id)
+            except (RuntimeError, cups.IPPError, cups.HTTPError):
+                pass
+            raise
 
 def try_connection():
     """try cups connection"""
     LOGGER.debug("Testing connection to cups printer server")
     try:
-        conn = Connection()
+        conn = __new_connection()
         conn.getPrinters()
     except RuntimeError:
         LOGGER.critical("Error while connecting to cups printer server!")
         print("Error while connecting to cups printer server!", file=stderr)
         exit(-1)
 
-def get_printers():
+def get_printers(server=None):
     """list available printers"""
     LOGGER.debug("Get available printers")
     printers = []
-    for printer in Connection().getPrinters():
+    for printer in __new_connection(server).getPrinters():
         printers.append(printer)
     LOGGER.debug("Available printers: %s",printers)
     return printers
 
-def print_pdf(pdf_bytes, printer):
-    """print pdf"""
-    temporary_file_path = join(TMP_DIRECTORY,"tmp.pdf")
-    # remove temporary file
-    if exists(temporary_file_path):
-        remove(temporary_file_path)
-    with open(temporary_file_path, 'bw') as tmp_file:
-        tmp_file.write(pdf_bytes)
+def get_candidates(configuration, sender=None) -> list:
+    """return the printers of the pool which may print a mail, restricted by the first routing rule matching the sender"""
+    pool = configuration['printer']['pool']
+    if sender is not None:
+        for route in configuration['printer'].get('routes', []):
+            if fnmatch(sender.lower(), route['from_address'].lower()):
+                return [printer for printer in pool if printer['name'] in route['printers']]
+    return pool
+
+def __printer_status(server) -> dict:
+    """return {printer: status} of a server with the number of queued jobs, queried at most every few seconds"""
+    with _STATUS_LOCK:
+        cached = _STATUS.get(server)
+        if cached is not None and monotonic() - cached[0] < PRINTER_STATUS_CACHE_SECONDS:
+            return cached[1]
+        import cups
+        connection = __new_connection(server)
+        status = {}
+        for name, attributes in connection.getPrinters().items():
+            status[name] = {"accepting": attributes.get('printer-is-accepting-jobs', True),
+                            "stopped": attributes.get('printer-state') == cups.IPP_PRINTER_STOPPED, "queued": 0}
+        # one query for the queues of all printers of the server
+        for job in connection.getJobs(which_jobs='not-completed', requested_attributes=['job-printer-uri']).values():
+            name = job.get('job-printer-uri', "").rsplit("/", 1)[-1]
+            if name in status:
+                status[name]["queued"] += 1
+        _STATUS[server] = (monotonic(), status)
+        return status
+
+def select_printer(candidates) -> tuple:
+    """return (printer, server) of the candidate with the shortest queue, stopped printers only if no other is left"""
+    if len(candidates) == 1:
+        return candidates[0]['name'], candidates[0].get('server')
+    import cups
+    best = None
+    for candidate in candidates:
+        try:
+            status = __printer_status(candidate.get('server')).get(candidate['name'])
+        except (RuntimeError, cups.IPPError, cups.HTTPError) as exception:
+            LOGGER.warning("Could not query cups server %s: %s", candidate.get('server') or _SERVER, exception)
+            continue
+        # printers which vanished or reject jobs are skipped
+        if status is None or not status["accepting"]:
+            continue
+        rank = (status["stopped"], status["queued"])
+        if best is None or rank < best[0]:
+            best = (rank, candidate, status)
+    if best is None:
+        raise RuntimeError(f"None of the printers {[candidate['name'] for candidate in candidates]} is accepting jobs")
+    # count the job until the next query of the server
+    best[2]["queued"] += 1
+    LOGGER.debug("Selected printer '%s' with %d queued jobs", best[1]['name'], best[0][1])
+    return best[1]['name'], best[1].get('server')
+
+def get_jobs(server=None, which_jobs='not-completed', first_job_id=-1) -> dict:
+    """return {job id: attributes} of the jobs on a cups server with one query"""
+    import cups
+    try:
+        return __connection(server).getJobs(which_jobs=which_jobs, first_job_id=first_job_id,
+                                            requested_attributes=['job-id', 'job-state', 'job-printer-uri'])
+    except (RuntimeError, cups.IPPError, cups.HTTPError):
+        __drop_connection(server)
+        raise
+
+def cancel_job(job_id, server=None) -> None:
+    """cancel a job on a cups server"""
+    import cups
+    try:
+        __connection(server).cancelJob(job_id)
+    except (RuntimeError, cups.IPPError, cups.HTTPError):
+        __drop_connection(server)
+        raise
+
+@timed("print")
+def print_pdf(pdf_bytes, printer, server=None):
+    """print pdf, return the cups job id"""
+    job_id = None
+    if _BACKEND == "stream":
+        LOGGER.debug("Streaming file to Printer '%s'", printer)
+        ## Print if variable True, Disable for Debugging in config.py
+        if PRINTER_ENABLE:
+            job_id = __stream_file([pdf_bytes], printer, server)
+        LOGGER.debug("Processing of file on Printer '%s' done.", printer)
+        return job_id
+
+    # every job gets its own spool file, so several print workers can run at once
+    file_descriptor, temporary_file_path = mkstemp(suffix=".pdf", dir=TMP_DIRECTORY)
+    try:
+        with open(file_descriptor, 'bw') as tmp_file:
+            if hasattr(pdf_bytes, 'read'):
+                copyfileobj(pdf_bytes, tmp_file)
+            else:
+                tmp_file.write(pdf_bytes)
         LOGGER.debug("Printing file '%s' on Printer '%s'", temporary_file_path, printer)
         ## Print if variable True, Disable for Debugging in config.py
         if PRINTER_ENABLE:
-            __print_file(temporary_file_path, printer)
-            remove(temporary_file_path)  # remove temporary file
+            job_id = __print_file(temporary_file_path, printer, server)
         LOGGER.debug("Processing of file '%s' on Printer '%s' done.", temporary_file_path, printer)
+    finally:
+        remove(temporary_file_path)  # remove temporary file
+    return job_id
+
+def __multiple_documents(printer, server=None) -> bool:
+    """return whether a printer accepts jobs of several documents, queried once per printer"""
+    if (server, printer) not in _MULTIPLE_DOCUMENTS:
+        import cups
+        try:
+            attributes = __new_connection(server).getPrinterAttributes(printer, requested_attributes=['multiple-document-jobs-supported'])
+            _MULTIPLE_DOCUMENTS[(server, printer)] = bool(attributes.get('multiple-document-jobs-supported', False))
+        except (RuntimeError, cups.IPPError, cups.HTTPError) as exception:
+            LOGGER.warning("Could not query the attributes of printer '%s': %s", printer, exception)
+            return False
+    return _MULTIPLE_DOCUMENTS[(server, printer)]
+
+def __merge(pdfs) -> bytes:
+    """merge pdfs into one pdf with pypdf"""
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for pdf in pdfs:
+        writer.append(pdf if hasattr(pdf, 'read') else BytesIO(pdf))
+    merged = BytesIO()
+    writer.write(merged)
+    return merged.getvalue()
+
+def batch_supported(printer, server=None) -> bool:
+    """return whether several pdfs can be printed as one job, as documents of the job or merged with pypdf"""
+    if __multiple_documents(printer, server):
+        return True
+    from importlib.util import find_spec
+    return find_spec('pypdf') is not None
+
+def print_documents(pdfs, printer, server=None):
+    """print pdfs in their order as one job, as documents of the job if the printer supports it, otherwise merged into one pdf, return the cups job id"""
+    if len(pdfs) == 1:
+        return print_pdf(pdfs[0], printer, server)
+    if not __multiple_documents(printer, server):
+        try:
+            merged = __merge(pdfs)
+        except ImportError:
+            raise RuntimeError(f"Printer '{printer}' does not accept jobs of several documents and pypdf is not installed")
+        except Exception as exception:
+            # e.g. an attachment which is named .pdf but is no valid pdf
+            raise ValueError(f"Could not merge {len(pdfs)} documents for Printer '{printer}': {exception}") from exception
+        LOGGER.debug("Merged %d documents for Printer '%s'", len(pdfs), printer)
+        return print_pdf(merged, printer, server)
+
+    job_id = None
+    with timed("print"):
+        if _BACKEND == "stream":
+            LOGGER.debug("Streaming %d documents to Printer '%s'", len(pdfs), printer)
+            if PRINTER_ENABLE:
+                job_id = __stream_file(pdfs, printer, server)
+            return job_id
+
+        paths = []
+        try:
+            for pdf in pdfs:
+                file_descriptor, temporary_file_path = mkstemp(suffix=".pdf", dir=TMP_DIRECTORY)
+                paths.append(temporary_file_path)
+                with open(file_descriptor, 'bw') as tmp_file:
+                    if hasattr(pdf, 'read'):
+                        copyfileobj(pdf, tmp_file)
+                    else:
+                        tmp_file.write(pdf)
+            LOGGER.debug("Printing %d files on Printer '%s'", len(paths), printer)
+            if PRINTER_ENABLE:
+                job_id = __print_files(paths, printer, server)
+        finally:
+            for path in paths:
+                remove(path)
+    return job_id
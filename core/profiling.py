@@ -0,0 +1,185 @@
+"""mailAttachmentPrinter profiling"""
+from contextlib import contextmanager
+from datetime import datetime
+from os import remove
+from os.path import exists,join
+from threading import Lock,Thread,Timer
+
+from .config import LOGGER,PROFILING_TOP,PROFILING_TRACE_FRAMES,TMP_DIRECTORY
+
+def _report_path(name, extension) -> str:
+    """return a path in the tmp directory which is unique per report"""
+    return join(TMP_DIRECTORY, f"{name}-{datetime.now():%Y%m%d-%H%M%S-%f}.{extension}")
+
+class _ProfileSession:
+    """collects the profiles of the next scans or of a period and writes them to one pstats file"""
+    def __init__(self, scans=None, seconds=None):
+        self.scans = scans
+        self.lock = Lock()
+        self.stats = None
+        self.finished = False
+        self.timer = None
+        if seconds:
+            self.timer = Timer(seconds, self.finish)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def add(self, profile, scan) -> None:
+        """add a profile, the session finishes after the last scan"""
+        from pstats import Stats
+        with self.lock:
+            if self.finished:
+                return
+            if self.stats is None:
+                self.stats = Stats(profile)
+            else:
+                self.stats.add(profile)
+            if scan and self.scans is not None:
+                self.scans -= 1
+                if self.scans > 0:
+                    return
+            else:
+                return
+        self.finish()
+
+    def finish(self) -> None:
+        """stop the session and write the collected profiles"""
+        global _SESSION
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        if self.timer is not None:
+            self.timer.cancel()
+        with _SESSION_LOCK:
+            if _SESSION is self:
+                _SESSION = None
+        if self.stats is None:
+            LOGGER.warning("Profiling finished without any profiled scan")
+            return
+        path = _report_path("profile", "pstats")
+        self.stats.dump_stats(path)
+        LOGGER.info("Wrote profile to %s", path)
+
+_SESSION = None
+_SESSION_LOCK = Lock()
+# only one block is profiled at a time, several profilers can not be active at once
+_PROFILER_LOCK = Lock()
+
+def start_profile(scans=None, seconds=None) -> bool:
+    """profile the next scans or the scans of the next seconds, return False if profiling is already running"""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            return False
+        _SESSION = _ProfileSession(scans, seconds)
+    LOGGER.info("Profiling the next %s", f"{scans} scans" if scans else f"{seconds} seconds")
+    return True
+
+@contextmanager
+def profiled(scan=False):
+    """profile a scan or print job if profiling was requested, blocks which run at the same time as a profiled block are not profiled"""
+    session = _SESSION
+    if session is None or not _PROFILER_LOCK.acquire(blocking=False):
+        yield
+        return
+    from cProfile import Profile
+    try:
+        profile = Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+    finally:
+        _PROFILER_LOCK.release()
+    session.add(profile, scan)
+
+def write_allocations(snapshot, path, focus=()) -> None:
+    """write the top allocations of a tracemalloc snapshot, overall and within the focused files"""
+    from tracemalloc import Filter
+    with open(path, 'w') as report:
+        sections = [("all", snapshot)]
+        if focus:
+            sections.append((", ".join(focus), snapshot.filter_traces([Filter(True, pattern) for pattern in focus])))
+        for title, traces in sections:
+            statistics = traces.statistics('lineno')
+            report.write(f"Top {PROFILING_TOP} allocations ({title}), {sum(statistic.size for statistic in statistics) / 1024:.1f} KiB in total\n")
+            for statistic in statistics[:PROFILING_TOP]:
+                report.write(f"{statistic.size / 1024:10.1f} KiB {statistic.count:8d} blocks  {statistic.traceback[0]}\n")
+            report.write("\n")
+    LOGGER.info("Wrote allocations to %s", path)
+
+def toggle_tracing() -> bool:
+    """start tracing allocations, or write the allocations since the start and stop, return True if tracing was started"""
+    import tracemalloc
+    from .render import trace as render_trace
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(PROFILING_TRACE_FRAMES)
+        render_trace(None)
+        LOGGER.info("Tracing allocations")
+        return True
+    write_snapshot()
+    tracemalloc.stop()
+    # weasyprint allocates in the render worker process, which writes its own report
+    render_trace(_report_path("tracemalloc-render", "txt"))
+    LOGGER.info("Stopped tracing allocations")
+    return False
+
+def write_snapshot() -> bool:
+    """write the allocations traced so far, return False if allocations are not traced"""
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+        return False
+    # the attachments are decoded in the reader
+    write_allocations(tracemalloc.take_snapshot(), _report_path("tracemalloc", "txt"), ("*/core/reader.py", "*/email/*"))
+    return True
+
+def _command(line) -> str:
+    """run a control socket command and return the answer"""
+    words = line.split()
+    if len(words) == 3 and words[0] == "profile" and words[1] in ("scans", "seconds") and words[2].isdigit() and int(words[2]) > 0:
+        started = start_profile(**{words[1]: int(words[2])})
+        return "profiling started" if started else "profiling is already running"
+    if words == ["trace"]:
+        return "tracing started" if toggle_tracing() else "tracing stopped"
+    if words == ["snapshot"]:
+        return "snapshot written" if write_snapshot() else "allocations are not traced"
+    return "commands: profile scans <n>, profile seconds <n>, trace, snapshot"
+
+_SERVER = None
+
+def start(configuration) -> None:
+    """profile on SIGUSR1, trace allocations on SIGUSR2 and listen on the control socket if configured"""
+    global _SERVER
+    from signal import signal,SIGUSR1,SIGUSR2
+    profiling = configuration['profiling']
+    signal(SIGUSR1, lambda signum, frame: start_profile(scans=profiling['scans']))
+    # writing the snapshot takes a while, it does not block the event loop
+    signal(SIGUSR2, lambda signum, frame: Thread(target=toggle_tracing, name="tracemalloc", daemon=True).start())
+
+    if profiling['socket'] == "" or _SERVER is not None:
+        return
+    from socketserver import StreamRequestHandler,ThreadingUnixStreamServer
+
+    class ControlHandler(StreamRequestHandler):
+        """answers one command per line"""
+        def handle(self):
+            for line in self.rfile:
+                self.wfile.write((_command(line.decode(errors='replace')) + "\n").encode())
+
+    if exists(profiling['socket']):
+        remove(profiling['socket'])
+    _SERVER = ThreadingUnixStreamServer(profiling['socket'], ControlHandler)
+    _SERVER.daemon_threads = True
+    Thread(target=_SERVER.serve_forever, name="control-socket", daemon=True).start()
+    LOGGER.info("Listening for profiling commands on %s", profiling['socket'])
+
+def shutdown() -> None:
+    """stop listening on the control socket"""
+    global _SERVER
+    if _SERVER is not None:
+        _SERVER.shutdown()
+        _SERVER.server_close()
+        remove(_SERVER.server_address)
+        _SERVER = None
@@ -1,79 +1,741 @@
 """mailAttachmentPrinter reader"""
 from sys import exit,stderr
-from imaplib import IMAP4,IMAP4_SSL
-from email import message_from_bytes
+from imaplib import IMAP4,IMAP4_SSL,Internaldate2tuple
+from binascii import a2b_base64,a2b_qp
+from hashlib import sha256
+from re import compile as compile_regex,sub as sub_regex
+from select import select
+from socket import SHUT_RDWR
+from ssl import SSLWantReadError
+from threading import Lock,RLock
+from time import mktime,monotonic
+from tempfile import SpooledTemporaryFile
+from json import dump,load
+from os import replace
+from os.path import exists
 
-from .printer import print_pdf
-from .config import LOGGER
+from .dedup import get_cache
+from .journal import get_journal,mailbox_key
+from .metrics import increment,observe,timed
+from .pipeline import PartiallyPrintedError,new_batch,submit
+from .profiling import profiled
+from .config import LOGGER,CHECKPOINT_FILE,TMP_DIRECTORY,IMAP_IDLE_TIMEOUT,IMAP_KEEPALIVE_INTERVAL,IMAP_RECONNECT_MAX_BACKOFF
+
+class _IMAP4_SSL(IMAP4_SSL):
+    """IMAP4_SSL which resumes a previous tls session to skip the full handshake"""
+    def __init__(self, host, port, ssl_context=None, tls_session=None):
+        self.tls_session = tls_session
+        IMAP4_SSL.__init__(self, host, port, ssl_context=ssl_context)
+
+    def _create_socket(self, timeout):
+        sock = IMAP4._create_socket(self, timeout)
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.host, session=self.tls_session)
+
+class ImapSession:
+    """authenticated imap connection with selected mailbox which is kept alive across scans"""
+    def __init__(self, configuration, mailbox='Inbox'):
+        self.configuration = configuration
+        self.mailbox = mailbox
+        self.mail = None
+        self.ssl_context = None
+        self.tls_session = None
+        self.failures = 0
+        self.next_attempt = 0
+        self.last_used = 0
+        # scans, IDLE and keepalives of a session run in different threads
+        self.lock = RLock()
+        # state of the selected mailbox, updated on every connect
+        self.capabilities = ()
+        self.uidvalidity = None
+        self.highestmodseq = None
+        # uids of printed mails which are not flagged as seen yet, e.g. because the connection died after printing
+        self.unflagged = set()
+        # uids of printed mails whose cups jobs did not complete yet, with seen_on_completion
+        self.awaiting = set()
+        # the flags are updated by the scans and by the completion callbacks of the tracker
+        self.flags_lock = Lock()
+        # connect/login latency of the last connection and totals for the lifetime of the session
+        self.stats = {"connects": 0, "tls_resumed": 0, "connect_seconds": 0.0, "login_seconds": 0.0,
+                      "connect_seconds_total": 0.0, "login_seconds_total": 0.0}
+
+    def __connect(self):
+        """connect, authenticate and select mailbox"""
+        imap = self.configuration['imap']
+        start = monotonic()
+        if imap['force_ssl']:
+            mail = _IMAP4_SSL(imap['server'], imap['port'], ssl_context=self.ssl_context, tls_session=self.tls_session)
+        else:
+            mail = IMAP4(imap['server'], imap['port'])
+        connected = monotonic()
+        try:
+            mail.login(imap['credentials']['username'], imap['credentials']['password'])
+            # capabilities may change after authentication
+            typ, data = mail.capability()
+            self.capabilities = tuple(data[-1].decode().upper().split())
+            # CONDSTORE lets the server report HIGHESTMODSEQ for the incremental sync
+            if 'CONDSTORE' in self.capabilities and 'ENABLE' in self.capabilities:
+                mail.enable('CONDSTORE')
+            mail.select(self.mailbox)
+            uidvalidity = int(mail.untagged_responses['UIDVALIDITY'][-1])
+            if uidvalidity != self.uidvalidity:
+                # the uids of the mailbox changed, the remembered ones refer to other mails
+                with self.flags_lock:
+                    self.unflagged.clear()
+                    self.awaiting.clear()
+            self.uidvalidity = uidvalidity
+            self.highestmodseq = int(mail.untagged_responses['HIGHESTMODSEQ'][-1]) if 'HIGHESTMODSEQ' in mail.untagged_responses else None
+        except Exception:
+            mail.shutdown()
+            raise
+        logged_in = monotonic()
+
+        if imap['force_ssl']:
+            if self.tls_session is not None and mail.sock.session_reused:
+                self.stats["tls_resumed"] += 1
+            self.ssl_context = mail.ssl_context
+            self.tls_session = mail.sock.session
+        self.stats["connects"] += 1
+        self.stats["connect_seconds"] = connected - start
+        self.stats["login_seconds"] = logged_in - connected
+        self.stats["connect_seconds_total"] += connected - start
+        self.stats["login_seconds_total"] += logged_in - connected
+        observe("stage_seconds", connected - start, stage="connect")
+        observe("stage_seconds", logged_in - connected, stage="login")
+        LOGGER.debug("Connected to imap server in %.3fs, login and select took %.3fs (connects: %d, tls sessions resumed: %d)",
+                     self.stats["connect_seconds"], self.stats["login_seconds"], self.stats["connects"], self.stats["tls_resumed"])
+        self.mail = mail
+
+    def get(self):
+        """return a live connection, reconnect with exponential backoff if the connection is dead"""
+        if self.mail is not None and monotonic() - self.last_used >= IMAP_KEEPALIVE_INTERVAL:
+            self.keepalive()
+        if self.mail is None:
+            if monotonic() < self.next_attempt:
+                raise IMAP4.abort(f"reconnect to imap server delayed for {self.next_attempt - monotonic():.0f}s")
+            try:
+                self.__connect()
+            except Exception:
+                self.failures += 1
+                self.next_attempt = monotonic() + min(2 ** self.failures, IMAP_RECONNECT_MAX_BACKOFF)
+                raise
+            self.failures = 0
+        # drop stale unsolicited responses so a long running session does not accumulate them, new mails announced in the meantime are kept
+        for name in [name for name in self.mail.untagged_responses if name not in ('EXISTS', 'RECENT')]:
+            del self.mail.untagged_responses[name]
+        self.last_used = monotonic()
+        return self.mail
+
+    def keepalive(self):
+        """send NOOP to keep the connection alive, drop it if the socket is dead"""
+        if self.mail is None:
+            return
+        try:
+            self.mail.noop()
+            self.last_used = monotonic()
+        except (IMAP4.error, OSError) as exception:
+            LOGGER.warning("Imap connection lost: %s", exception)
+            self.close()
+
+    def close(self):
+        """logout and drop connection"""
+        if self.mail is None:
+            return
+        try:
+            self.mail.logout()
+        except (IMAP4.error, OSError):
+            pass
+        self.mail = None
+
+_SESSIONS = {}
+_SESSIONS_LOCK = RLock()
+
+def get_session(configuration) -> ImapSession:
+    """return the session for an account and mailbox, create it if necessary"""
+    imap = configuration['imap']
+    mailbox = imap.get('mailbox', 'Inbox')
+    key = (imap['server'], imap['port'], imap['credentials']['username'], mailbox)
+    with _SESSIONS_LOCK:
+        if key not in _SESSIONS:
+            _SESSIONS[key] = ImapSession(configuration, mailbox)
+        return _SESSIONS[key]
+
+def keepalive_sessions():
+    """send NOOP on all idle sessions, sessions which are scanning or idling are skipped"""
+    with _SESSIONS_LOCK:
+        sessions = list(_SESSIONS.values())
+    for session in sessions:
+        if monotonic() - session.last_used >= IMAP_KEEPALIVE_INTERVAL and session.lock.acquire(blocking=False):
+            try:
+                session.keepalive()
+            finally:
+                session.lock.release()
+
+def abort_sessions():
+    """shut down the sockets of all sessions, so threads blocked in IDLE return"""
+    with _SESSIONS_LOCK:
+        sessions = list(_SESSIONS.values())
+    for session in sessions:
+        mail = session.mail
+        if mail is not None:
+            try:
+                mail.sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
 
 def try_connection(configuration):
     """try imap connection"""
     LOGGER.debug("Testing connection and authentication to imap server")
 
-    if configuration['imap']['force_ssl']:
-        mail = IMAP4_SSL(configuration['imap']['server'], configuration['imap']['port'])
-    else:
-        mail = IMAP4(configuration['imap']['server'], configuration['imap']['port'])
-
-    password = configuration['imap']['credentials']['password']
-    username = configuration['imap']['credentials']['username']
-
     try:
-        mail.login(username, password)
+        # the connection is kept open for the first scan
+        get_session(configuration).get()
     except Exception as exception:
         LOGGER.critical("Error while connection to imap server!")
         print("Error while connection to imap server!", file=stderr)
         print(exception, file=stderr)
         exit(-1)
 
-def read_email(configuration):
-    """read mail from imap server"""
-    LOGGER.info("Checking for emails")
+_FETCH_TOKEN = compile_regex(rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"|(?P<atom>[^\s()"]+))')
 
-    if configuration['imap']['force_ssl']:
-        mail = IMAP4_SSL(configuration['imap']['server'], configuration['imap']['port'])
-    else:
-        mail = IMAP4(configuration['imap']['server'], configuration['imap']['port'])
+def __tokenize(data) -> list:
+    """split a fetch response into tokens, literals are returned as bytes"""
+    tokens = []
+    for chunk in data:
+        literal = None
+        if isinstance(chunk, tuple):
+            chunk, literal = chunk
+            # strip literal marker, the literal itself follows as separate token
+            chunk = chunk[:chunk.rindex(b'{')]
+        position = 0
+        while position < len(chunk):
+            match = _FETCH_TOKEN.match(chunk, position)
+            if match is None or match.end() == position:
+                break
+            position = match.end()
+            if match.group('open'):
+                tokens.append('(')
+            elif match.group('close'):
+                tokens.append(')')
+            elif match.group('quoted') is not None:
+                tokens.append(sub_regex(rb'\\(.)', rb'\1', match.group('quoted')).decode(errors='replace'))
+            else:
+                atom = match.group('atom').decode(errors='replace')
+                tokens.append(None if atom.upper() == 'NIL' else atom)
+        if literal is not None:
+            tokens.append(literal)
+    return tokens
+
+def __parse_fetch_response(data) -> dict:
+    """parse a UID FETCH response into {uid: {item name: value}}"""
+    stack = [[]]
+    for token in __tokenize(data):
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            finished = stack.pop()
+            stack[-1].append(finished)
+        else:
+            stack[-1].append(token)
+
+    messages = {}
+    tokens = stack[0]
+    for items in tokens[1::2]:
+        items = {str(key).upper(): value for key, value in zip(items[::2], items[1::2])}
+        # unsolicited FETCH responses, e.g. flag changes by other clients, carry no UID
+        if 'UID' in items:
+            messages[items['UID']] = items
+    return messages
+
+def __pdf_parts(structure, section="") -> list:
+    """return (section, encoding, size) of all parts of a BODYSTRUCTURE which should be printed"""
+    # multipart: children followed by subtype and extension data
+    if isinstance(structure[0], list):
+        parts = []
+        for index, child in enumerate(structure, start=1):
+            if not isinstance(child, list):
+                break
+            parts += __pdf_parts(child, f"{section}.{index}" if section else str(index))
+        return parts
+
+    section = section or "1"
+    maintype, subtype = str(structure[0]).lower(), str(structure[1]).lower()
+    encoding = str(structure[5]).lower()
+    size = int(structure[6] or 0)
+
+    if maintype == 'message' and subtype == 'rfc822':
+        # descend into attached mails like msg.walk() does
+        body = structure[8]
+        return __pdf_parts(body, section if isinstance(body[0], list) else f"{section}.1")
+
+    #find the attachment part - so skip all the other parts
+    if maintype == 'text': return []
+    # extension data of a basic part starts after 7 fields with the md5 sum followed by the disposition
+    disposition = structure[8] if len(structure) > 8 else None
+    if not isinstance(disposition, list): return []
+    disposition_parameters = disposition[1] if isinstance(disposition[1], list) else []
+    if str(disposition[0]).lower() == 'inline' and disposition_parameters == []: return []
+
+    # print only pdf
+    if f"{maintype}/{subtype}" == 'application/pdf':
+        return [(section, encoding, size)]
+    # same lookup order as part.get_filename(): disposition filename, then content type name
+    parameters = dict(zip([str(key).lower() for key in disposition_parameters[::2]], disposition_parameters[1::2]))
+    if isinstance(structure[2], list):
+        parameters.setdefault('filename', dict(zip([str(key).lower() for key in structure[2][::2]], structure[2][1::2])).get('name'))
+    filename = str(parameters.get('filename') or "")
+    if len(filename.split("?")) > 1 and filename.split("?")[-2].endswith(".pdf"):
+        return [(section, encoding, size)]
+    return []
+
+class _Decoder:
+    """incremental content transfer decoding into a spooled temporary file, or into a spool file of the journal"""
+    def __init__(self, encoding, spool_threshold, journal=None):
+        self.encoding = encoding
+        self.file = journal.spool_file() if journal is not None else SpooledTemporaryFile(max_size=spool_threshold, dir=TMP_DIRECTORY)
+        self.rest = b''
+        # hash of the decoded attachment, computed while decoding
+        self.digest = sha256()
+
+    def __output(self, decoded):
+        """hash and store decoded data"""
+        self.digest.update(decoded)
+        self.file.write(decoded)
+
+    def write(self, data):
+        """decode as much of the data as possible, keep incomplete encoded units for the next chunk"""
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        data = self.rest + (data or b'')
+        if self.encoding == 'base64':
+            # base64 decodes in units of 4 characters, everything else is ignored by the decoder anyway
+            data = sub_regex(rb'[^A-Za-z0-9+/=]', b'', data)
+            end = len(data) - len(data) % 4
+            self.rest = data[end:]
+            self.__output(a2b_base64(data[:end]))
+        elif self.encoding == 'quoted-printable':
+            # soft line breaks and escapes never span lines
+            end = data.rfind(b'\n') + 1
+            self.rest = data[end:]
+            self.__output(a2b_qp(data[:end]))
+        else:
+            self.__output(data)
+
+    def close(self):
+        """decode the remaining data and return the file positioned at the start"""
+        if self.rest:
+            self.__output(a2b_base64(self.rest) if self.encoding == 'base64' else a2b_qp(self.rest))
+            self.rest = b''
+        self.file.seek(0)
+        return self.file
+
+def __message_set(uids) -> str:
+    """compress uids into an imap message set, e.g. 1:3,7"""
+    ranges = []
+    for uid in sorted(int(uid) for uid in uids):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(low) if low == high else f"{low}:{high}" for low, high in ranges)
+
+def __fetch_chunked(mail, uid, section, encoding, configuration):
+    """fetch a large body part in chunks, so only one chunk is held in memory"""
+    chunk_size = configuration['imap']['fetch_chunk_size']
+    decoder = _Decoder(encoding, configuration['imap']['spool_threshold'], get_journal(configuration))
+    offset = 0
+    while True:
+        with timed("fetch"):
+            typ, data = mail.uid('FETCH', uid, f'(UID BODY.PEEK[{section}]<{offset}.{chunk_size}>)')
+        with timed("parse"):
+            chunk = __parse_fetch_response(data)[uid].get(f'BODY[{section}]<{offset}>') or b''
+            decoder.write(chunk)
+        increment("fetched_bytes_total", len(chunk))
+        offset += len(chunk)
+        if len(chunk) < chunk_size:
+            return decoder.close(), decoder.digest.hexdigest()
+
+def __sender(envelope):
+    """return the address of the first sender of an ENVELOPE, None if it has none"""
+    # envelope: (date subject from sender ...), address: (name adl mailbox host)
+    addresses = envelope[2] if isinstance(envelope, list) and len(envelope) > 2 else None
+    if not isinstance(addresses, list) or not addresses:
+        return None
+    mailbox, host = addresses[0][2], addresses[0][3]
+    return f"{mailbox}@{host}" if mailbox and host else None
 
-    password = configuration['imap']['credentials']['password']
-    username = configuration['imap']['credentials']['username']
+def __arrival(internaldate):
+    """return the INTERNALDATE of a mail as unix time, None if it is missing"""
+    if internaldate is None:
+        return None
+    return mktime(Internaldate2tuple(b'INTERNALDATE "' + internaldate.encode() + b'"'))
 
-    mail.login(username, password)
-    mail.select('Inbox')
+def __fetch_attachments(mail, uids, configuration) -> tuple:
+    """fetch the pdf parts of a batch of mails, return ({uid: [(decoded attachment file, sha256), ...]}, {uid: (sender, arrival)})"""
+    # fetch only the structure and download nothing but the pdf parts
+    items = ['UID', 'BODYSTRUCTURE']
+    # the sender is only needed for routing rules, the arrival time only for the print latency
+    if configuration['printer'].get('routes'):
+        items.append('ENVELOPE')
+    if configuration['tracking']['enabled']:
+        items.append('INTERNALDATE')
+    with timed("fetch"):
+        typ, data = mail.uid('FETCH', __message_set(uids), '(' + ' '.join(items) + ')')
+    with timed("parse"):
+        response = __parse_fetch_response(data)
+        parts = {uid: __pdf_parts(items['BODYSTRUCTURE']) for uid, items in response.items()}
+        headers = {uid: (__sender(items.get('ENVELOPE')), __arrival(items.get('INTERNALDATE'))) for uid, items in response.items()}
+
+    # small parts of mails with the same sections are fetched with one command
+    chunk_size = configuration['imap']['fetch_chunk_size']
+    groups = {}
+    for uid, sections in parts.items():
+        small_sections = tuple((section, encoding) for section, encoding, size in sections if size <= chunk_size)
+        if small_sections:
+            groups.setdefault(small_sections, []).append(uid)
+    decoded = {}
+    for sections, group in groups.items():
+        with timed("fetch"):
+            typ, data = mail.uid('FETCH', __message_set(group), '(UID ' + ' '.join(f'BODY.PEEK[{section}]' for section, _ in sections) + ')')
+        with timed("parse"):
+            for uid, items in __parse_fetch_response(data).items():
+                for section, encoding in sections:
+                    decoder = _Decoder(encoding, configuration['imap']['spool_threshold'], get_journal(configuration))
+                    decoder.write(items[f'BODY[{section}]'])
+                    increment("fetched_bytes_total", len(items[f'BODY[{section}]'] or b''))
+                    decoded[(uid, section)] = (decoder.close(), decoder.digest.hexdigest())
+
+    attachments = {}
+    for uid, sections in parts.items():
+        for section, encoding, size in sections:
+            if size > chunk_size:
+                decoded[(uid, section)] = __fetch_chunked(mail, uid, section, encoding, configuration)
+        attachments[uid] = [decoded[(uid, section)] for section, _, _ in sections]
+    return attachments, headers
+
+_CHECKPOINTS = {}
+# mailboxes are scanned at the same time, their checkpoints share one file
+_CHECKPOINTS_LOCK = Lock()
+
+def __checkpoint_key(session) -> str:
+    """return the key of the checkpoint of a session's mailbox"""
+    return mailbox_key(session.configuration)
+
+def __load_checkpoint(session) -> dict:
+    """return the persisted sync checkpoint of the session's mailbox"""
+    with _CHECKPOINTS_LOCK:
+        if not _CHECKPOINTS and exists(CHECKPOINT_FILE):
+            try:
+                with open(CHECKPOINT_FILE, 'r') as checkpoint_file:
+                    _CHECKPOINTS.update(load(checkpoint_file))
+            except (OSError, ValueError) as exception:
+                LOGGER.warning("Could not load sync checkpoints, doing a full sync: %s", exception)
+        return _CHECKPOINTS.get(__checkpoint_key(session), {})
+
+def __save_checkpoint(session, checkpoint) -> None:
+    """persist the sync checkpoint of the session's mailbox"""
+    with _CHECKPOINTS_LOCK:
+        if _CHECKPOINTS.get(__checkpoint_key(session)) == checkpoint:
+            return
+        _CHECKPOINTS[__checkpoint_key(session)] = checkpoint
+        # write to a temporary file first, so a crash never leaves a truncated checkpoint file
+        with open(CHECKPOINT_FILE + ".tmp", 'w') as checkpoint_file:
+            dump(_CHECKPOINTS, checkpoint_file)
+        replace(CHECKPOINT_FILE + ".tmp", CHECKPOINT_FILE)
+
+def __highestmodseq(mail, session) -> None:
+    """refresh the highest modseq of the selected mailbox, the one reported on select is outdated once the session is kept across scans"""
+    # STATUS should not be used on the selected mailbox, servers report changes with the HIGHESTMODSEQ response code of a NOOP instead
+    mail.noop()
+    highestmodseq = mail.untagged_responses.pop('HIGHESTMODSEQ', None)
+    if highestmodseq:
+        session.highestmodseq = max(session.highestmodseq, int(highestmodseq[-1]))
+
+def __search(mail, configuration, session, checkpoint) -> list:
+    """search unseen mails, only above the checkpoint if it is still valid, return their uids"""
+    if checkpoint.get('uidvalidity') == session.uidvalidity:
+        # new mails, and with CONDSTORE also older mails which were changed since the last scan
+        criteria = f"UID {checkpoint['last_uid'] + 1}:*"
+        if checkpoint.get('highestmodseq') is not None and session.highestmodseq is not None:
+            criteria = f"OR ({criteria}) MODSEQ {checkpoint['highestmodseq'] + 1}"
+        criteria = f"UNSEEN {criteria}"
+    else:
+        if checkpoint:
+            LOGGER.info("UIDVALIDITY of mailbox '%s' changed, doing a full sync", session.mailbox)
+        criteria = "UNSEEN"
 
     # only check unseen emails
+    with timed("search"):
+        try:
+            from_address = configuration['imap']['from_address']
+            typ, data = mail.uid('SEARCH', None, f'({criteria} FROM "{from_address}")')
+        except Exception:
+            typ, data = mail.uid('SEARCH', None, f'({criteria})')
+
+    # with CONDSTORE the response ends with the highest modseq of the found mails: "1 2 (MODSEQ 42)"
+    response = data[0].decode()
+    modseq = None
+    if "(MODSEQ" in response.upper():
+        response, _, modseq = response.partition("(")
+        modseq = int(modseq.strip(")").split()[-1])
+        # the found mails changed before the search, so do all mails with a lower modseq, e.g. if the server reports none on NOOP
+        session.highestmodseq = max(session.highestmodseq or 0, modseq)
+    uids = [int(uid) for uid in response.split()]
+    # "n:*" always includes the highest uid, even if it is below n
+    if checkpoint.get('uidvalidity') == session.uidvalidity:
+        uids = [uid for uid in uids if uid > checkpoint['last_uid'] or modseq is not None]
+    return uids
+
+def __flag_seen(mail, configuration, session, uids=()) -> None:
+    """flag printed mails as seen, mails which could not be flagged, e.g. because the connection died, are flagged with the next scan"""
+    with session.flags_lock:
+        session.unflagged.update(int(uid) for uid in uids)
+        unflagged = sorted(session.unflagged)
+    if not unflagged:
+        return
+    journal = get_journal(configuration)
+    if journal is not None:
+        # the mails are only flagged once their spool files and records are on disk
+        journal.sync()
+    # BODY.PEEK does not set the seen flag implicitly
+    batch_size = configuration['imap']['batch_size']
+    for start in range(0, len(unflagged), batch_size):
+        flagged = unflagged[start:start + batch_size]
+        mail.uid('STORE', __message_set(flagged), '+FLAGS.SILENT', '(\\Seen)')
+        with session.flags_lock:
+            session.unflagged.difference_update(flagged)
+        if journal is not None:
+            journal.acknowledged(configuration, session.uidvalidity, flagged)
+
+def __prepare_scan(mail, configuration, session) -> tuple:
+    """flag the mails printed before, search new unseen mails, return (checkpoint, uids, uids still printing from the journal)"""
+    checkpoint = __load_checkpoint(session)
+    if checkpoint.get('uidvalidity') != session.uidvalidity:
+        checkpoint = {}
+    # journaled mails are printed from their spool files and never fetched again, the ones printed in the meantime are flagged
+    journal = get_journal(configuration)
+    printing, journaled = journal.uids(configuration, session.uidvalidity) if journal is not None else ([], [])
+    __flag_seen(mail, configuration, session, journaled)
+    # the changes up to here are covered by the search, including the flags just set
+    if session.highestmodseq is not None:
+        __highestmodseq(mail, session)
+    # the mails announced up to here are found by the search, the ones announced later wake up the next IDLE
+    mail.untagged_responses.pop('EXISTS', None)
+    mail.untagged_responses.pop('RECENT', None)
+    uids = __search(mail, configuration, session, checkpoint)
+    # mails waiting for their cups jobs are unseen but printed already
+    with session.flags_lock:
+        printed = session.unflagged | session.awaiting
+    uids = [uid for uid in uids if uid not in printing and uid not in journaled and uid not in printed]
+    return checkpoint, uids, printing
+
+def __flag_on_completion(configuration, session, uid, completions, digests) -> None:
+    """flag a mail as seen with the next scan once cups completed all of its jobs, a mail whose job failed is retried"""
+    cache = get_cache(configuration)
+    remaining = [len(completions)]
+
+    def completed(completion):
+        exception = completion.exception()
+        with session.flags_lock:
+            # only the first failed job of a mail is reported
+            if uid not in session.awaiting:
+                return
+            remaining[0] -= 1
+            if exception is None and remaining[0] > 0:
+                return
+            session.awaiting.discard(uid)
+            if exception is None:
+                session.unflagged.add(uid)
+        if exception is None:
+            increment("attachments_total", len(digests), result="printed")
+            return
+        # the checkpoint is held below waiting mails, so the mail is found again with the next scan
+        LOGGER.error("Error while printing mail %s: %s", uid, exception)
+        increment("attachments_total", len(digests), result="failed")
+        if cache is not None:
+            for digest in digests:
+                cache.discard(digest)
+            cache.save()
+
+    with session.flags_lock:
+        session.awaiting.add(uid)
+    for completion in completions:
+        completion.add_done_callback(completed)
+
+def __wait_for_jobs(jobs, configuration, session) -> list:
+    """wait until the queued mails are submitted to cups and remember them to be flagged as seen, return the uids of the mails which failed"""
+    cache = get_cache(configuration)
+    failed = []
+    for uid, job, digests in jobs:
+        if job is not None:
+            try:
+                results = job.result()
+            except Exception as exception:
+                # the mail stays unseen and is retried with the next scan
+                LOGGER.error("Error while printing mail %s: %s", uid, exception)
+                # attachments printed before the failure stay in the dedup cache, so only the others are printed again
+                printed = exception.printed if isinstance(exception, PartiallyPrintedError) else 0
+                increment("attachments_total", printed, result="printed")
+                increment("attachments_total", len(digests) - printed, result="failed")
+                failed.append(int(uid))
+                if cache is not None:
+                    for digest in digests[printed:]:
+                        cache.discard(digest)
+                continue
+            # optionally the mail is only flagged as seen once cups completed its jobs, the scan does not wait for them
+            completions = [completion for _, _, _, completion in results if completion is not None]
+            if configuration['tracking']['seen_on_completion'] and completions:
+                __flag_on_completion(configuration, session, int(uid), completions, digests)
+                continue
+            increment("attachments_total", len(digests), result="printed")
+        with session.flags_lock:
+            session.unflagged.add(int(uid))
+    if cache is not None:
+        cache.save()
+    return failed
+
+def __print_mails(mail, configuration, session, checkpoint, uids, printing) -> int:
+    """print the attachments of the found mails and flag them as seen, return the number of new mails"""
+    increment("mails_total", len(uids))
+    journal = get_journal(configuration)
+
+    # fetching continues while the print workers submit the queued mails to cups
+    cache = get_cache(configuration)
+    # with batching the attachments of the scan are printed together once all mails are fetched
+    print_batch = new_batch(configuration)
+    jobs = []
+    batch_size = configuration['imap']['batch_size']
+    try:
+        for start in range(0, len(uids), batch_size):
+            batch = [str(uid) for uid in uids[start:start + batch_size]]
+            LOGGER.debug("%d new mails detected, processing...", len(batch))
+            attachments, headers = __fetch_attachments(mail, batch, configuration)
+            for uid in batch:
+                spooled = []
+                for document, digest in attachments.get(uid, []):
+                    if cache is not None and cache.check_and_add(digest):
+                        LOGGER.info("Skipping attachment of mail %s, it was already printed (sha256: %s)", uid, digest)
+                        increment("attachments_total", result="skipped")
+                        if journal is not None:
+                            journal.discard(document)
+                        else:
+                            document.close()
+                        continue
+                    spooled.append((document, digest))
+                sender, arrival = headers.get(uid, (None, None))
+                keys = journal.fetched(configuration, session.uidvalidity, uid, spooled, sender, arrival) if journal is not None and spooled else []
+                job = None
+                if spooled and print_batch is not None:
+                    job = print_batch.add([document for document, _ in spooled], sender, arrival)
+                elif spooled:
+                    job = submit(configuration, [document for document, _ in spooled], sender, arrival)
+                if keys:
+                    journal.follow(keys, job)
+                jobs.append((uid, job, [digest for _, digest in spooled]))
+    finally:
+        # gathered mails are printed even if fetching the following ones failed, like mails which were submitted one by one
+        if print_batch is not None:
+            print_batch.flush()
+        # printed mails are remembered even if the connection died, so they are flagged and not printed again with the next scan
+        failed = __wait_for_jobs(jobs, configuration, session)
+
+    __flag_seen(mail, configuration, session)
+
+    # advance the checkpoint, but never past a mail which has to be retried, is still printing from the journal or waits for its cups jobs
+    with session.flags_lock:
+        awaiting = list(session.awaiting)
+    held = failed + printing + awaiting
+    last_uid = checkpoint.get('last_uid', 0)
+    if held:
+        last_uid = max(last_uid, min(held) - 1)
+    elif uids:
+        last_uid = max([last_uid] + uids)
+    # the next scan searches the changes since this one, unless an older mail which was changed may have to be retried
+    highestmodseq = checkpoint.get('highestmodseq') if failed or awaiting else session.highestmodseq
+    __save_checkpoint(session, {"uidvalidity": session.uidvalidity, "last_uid": last_uid, "highestmodseq": highestmodseq})
+    return len(uids)
+
+def read_email(configuration) -> int:
+    """read mail from imap server, return the number of new mails"""
+    session = get_session(configuration)
+    LOGGER.info("Checking for emails in '%s' of %s", session.mailbox, configuration['imap']['credentials']['username'])
+
+    with session.lock, timed("scan"), profiled(scan=True):
+        try:
+            mail = session.get()
+            try:
+                scan = __prepare_scan(mail, configuration, session)
+            except (IMAP4.abort, OSError):
+                # the kept connection died since the last scan, retry once on a fresh connection, nothing was printed yet
+                session.close()
+                mail = session.get()
+                scan = __prepare_scan(mail, configuration, session)
+            # never retried, a failure after the mails were queued would print them again
+            return __print_mails(mail, configuration, session, *scan)
+        except (IMAP4.error, OSError) as exception:
+            session.close()
+            LOGGER.error("Error while reading mails: %s", exception)
+            return 0
+
+def __buffered(mail) -> bool:
+    """return whether a response was already read from the socket, buffered responses are not visible to select"""
+    timeout = mail.sock.gettimeout()
+    mail.sock.setblocking(False)
     try:
-        from_address = configuration['imap']['from_address']
-        typ, data = mail.search(None, f'(UNSEEN FROM "{from_address}")')
-    except Exception:
-        typ, data = mail.search(None, f'(UNSEEN)')
-
-    # keep track if an attachment was printed
-    attachment_printed = False
-
-    for num in data[0].split():
-        LOGGER.debug("New mail detected, processing...")
-        typ, data = mail.fetch(num, '(RFC822)')
-        msg = message_from_bytes(data[0][1])
-
-        for part in msg.walk():
-            #find the attachment part - so skip all the other parts
-            if part.get_content_maintype() == 'multipart': continue
-            if part.get_content_maintype() == 'text': continue
-            if part.get('Content-Disposition') == 'inline': continue
-            if part.get('Content-Disposition') is None: continue
-            # print only pdf
-            if part.get_content_type() == 'application/pdf':
-                LOGGER.info("Printing mail attachment")
-                print_pdf(part.get_payload(decode=True),configuration['printer']['name'])
-                attachment_printed = True
-            elif len(part.get_filename().split("?")) > 1 and part.get_filename().split("?")[-2].endswith(".pdf"):
-                LOGGER.info("Printing mail attachment")
-                print_pdf(part.get_payload(decode=True),configuration['printer']['name'])
-                attachment_printed = True
-
-        if attachment_printed and configuration["tide"]["enabled"]:
-            from .tides import create_tide_overview
-            create_tide_overview(configuration)
-
-    mail.logout()
+        # the buffer of imaplib, refilled from the data which is already decrypted by ssl or waiting on the socket
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, SSLWantReadError):
+        return False
+    finally:
+        mail.sock.settimeout(timeout)
+
+def __idle(mail, timeout) -> bool:
+    """send IDLE and block until the server announces new mails or the timeout is reached, return True on new mails"""
+    # mails which were announced during the last scan or a keepalive are not found by a search yet
+    if 'EXISTS' in mail.untagged_responses or 'RECENT' in mail.untagged_responses:
+        return True
+    # imaplib has no IDLE command, so the command is written to the socket directly
+    tag = mail._new_tag()
+    mail.tagged_commands[tag] = None
+    mail.send(tag + b' IDLE\r\n')
+
+    # wait for continuation response
+    while mail._get_response() is not None:
+        if mail.tagged_commands[tag] is not None:
+            raise mail.error(f"IDLE failed: {mail.tagged_commands[tag]}")
+    LOGGER.debug("Waiting for new mails (IDLE)")
+
+    deadline = monotonic() + timeout
+    while 'EXISTS' not in mail.untagged_responses and 'RECENT' not in mail.untagged_responses:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            break
+        if not __buffered(mail):
+            readable, _, _ = select([mail.sock], [], [], remaining)
+            if not readable:
+                break
+        mail._get_response()
+        if 'BYE' in mail.untagged_responses:
+            raise mail.abort(f"imap server closed connection: {mail.untagged_responses['BYE']}")
+    new_mails = 'EXISTS' in mail.untagged_responses or 'RECENT' in mail.untagged_responses
+
+    mail.send(b'DONE\r\n')
+    typ, data = mail._get_tagged_response(tag)
+    if typ != 'OK':
+        raise mail.error(f"IDLE failed: {data}")
+    return new_mails
+
+def wait_email(configuration, timeout=IMAP_IDLE_TIMEOUT):
+    """wait in IMAP IDLE until the server announces new mails, return True on new mails, False on timeout and None if IDLE is unsupported"""
+    session = get_session(configuration)
+    with session.lock:
+        try:
+            mail = session.get()
+            if 'IDLE' not in session.capabilities:
+                LOGGER.warning("Imap server does not support IDLE, falling back to polling")
+                return None
+            new_mails = __idle(mail, timeout)
+            session.last_used = monotonic()
+            return new_mails
+        except (IMAP4.abort, OSError):
+            session.close()
+            raise
@@ -0,0 +1,165 @@
+"""mailAttachmentPrinter render"""
+from multiprocessing import get_context
+from threading import Lock
+
+from .config import LOGGER,RENDER_WORKER_MAX_RENDERS,RENDER_WORKER_MAX_RSS
+
+def _trace(path) -> tuple:
+    """start tracing allocations in the worker, or write them to path and stop"""
+    import tracemalloc
+    from .config import PROFILING_TRACE_FRAMES
+    if path is None:
+        tracemalloc.start(PROFILING_TRACE_FRAMES)
+    elif tracemalloc.is_tracing():
+        from .profiling import write_allocations
+        write_allocations(tracemalloc.take_snapshot(), path, ("*/weasyprint/*", "*/markdown2.py"))
+        tracemalloc.stop()
+    return (True, None)
+
+def _work(connection, warmup_text) -> None:
+    """render markdown texts received over the pipe to pdf bytes until the pipe is closed"""
+    from resource import getrusage,RUSAGE_SELF
+    from markdown2 import markdown
+    from weasyprint import HTML
+
+    # the first layout pays for font discovery and css parsing
+    HTML(string=markdown(warmup_text)).write_pdf()
+    while True:
+        try:
+            markdown_text = connection.recv()
+        except EOFError:
+            return
+        if markdown_text is None:
+            return
+        if isinstance(markdown_text, tuple):
+            connection.send(_trace(markdown_text[1]) + (getrusage(RUSAGE_SELF).ru_maxrss * 1024,))
+            continue
+        try:
+            result = (True, HTML(string=markdown(markdown_text)).write_pdf())
+        except Exception as exception:
+            result = (False, repr(exception))
+        # peak resident memory of the worker in bytes
+        connection.send(result + (getrusage(RUSAGE_SELF).ru_maxrss * 1024,))
+
+class RenderWorker:
+    """long-lived subprocess with a warm WeasyPrint, restarted after a number of renders or above a memory ceiling"""
+    def __init__(self, warmup_text, max_renders, max_rss):
+        self.warmup_text = warmup_text
+        self.max_renders = max_renders
+        self.max_rss = max_rss
+        self.lock = Lock()
+        self.process = None
+        self.connection = None
+        self.renders = 0
+
+    def __start(self) -> None:
+        """start a new worker process"""
+        context = get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_work, args=(child_connection, self.warmup_text), name="render-worker", daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.renders = 0
+        LOGGER.debug("Started render worker with pid %d", self.process.pid)
+
+    def __stop(self) -> None:
+        """stop the worker process, it is killed if it does not exit in time"""
+        if self.process is None:
+            return
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+        self.process = None
+        self.connection = None
+
+    def start(self) -> None:
+        """start the worker process if it is not running"""
+        with self.lock:
+            if self.process is None or not self.process.is_alive():
+                self.__stop()
+                self.__start()
+
+    def render(self, markdown_text) -> bytes:
+        """render markdown text to pdf bytes, a crashed worker is restarted once"""
+        with self.lock:
+            for attempt in range(2):
+                if self.process is None or not self.process.is_alive():
+                    self.__stop()
+                    self.__start()
+                try:
+                    self.connection.send(markdown_text)
+                    success, result, rss = self.connection.recv()
+                    break
+                except (EOFError, OSError) as exception:
+                    LOGGER.warning("Render worker died: %s", exception)
+                    self.__stop()
+                    if attempt == 1:
+                        raise
+
+            self.renders += 1
+            if self.renders >= self.max_renders or rss > self.max_rss:
+                LOGGER.info("Restarting render worker after %d renders with %d MiB", self.renders, rss // (1024 * 1024))
+                self.__stop()
+                # start the replacement right away, so it is warm for the next render
+                self.__start()
+
+        if not success:
+            raise RuntimeError(f"Could not render pdf: {result}")
+        return result
+
+    def trace(self, path) -> None:
+        """start tracing allocations in a running worker, or write them to path and stop, a restarted worker is not traced"""
+        with self.lock:
+            if self.process is None or not self.process.is_alive():
+                return
+            try:
+                self.connection.send(("trace", path))
+                self.connection.recv()
+            except (EOFError, OSError) as exception:
+                LOGGER.warning("Could not trace render worker: %s", exception)
+
+    def close(self) -> None:
+        """stop the worker process"""
+        with self.lock:
+            self.__stop()
+
+_WORKER = None
+_WORKER_LOCK = Lock()
+
+def start(warmup_text="") -> RenderWorker:
+    """start the render worker if it is not running yet"""
+    global _WORKER
+    with _WORKER_LOCK:
+        if _WORKER is None:
+            _WORKER = RenderWorker(warmup_text, RENDER_WORKER_MAX_RENDERS, RENDER_WORKER_MAX_RSS)
+        _WORKER.start()
+        return _WORKER
+
+def render(markdown_text) -> bytes:
+    """render markdown text to pdf bytes in the render worker"""
+    with _WORKER_LOCK:
+        worker = _WORKER
+    if worker is None:
+        worker = start()
+    return worker.render(markdown_text)
+
+def trace(path) -> None:
+    """start tracing allocations in the render worker if it is running, or write them to path and stop"""
+    with _WORKER_LOCK:
+        worker = _WORKER
+    if worker is not None:
+        worker.trace(path)
+
+def shutdown() -> None:
+    """stop the render worker"""
+    global _WORKER
+    with _WORKER_LOCK:
+        if _WORKER is not None:
+            _WORKER.close()
+            _WORKER = None
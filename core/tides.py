@@ -1,16 +1,25 @@
 """mailAttachmentPrinter tides"""
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from csv import reader
 from datetime import datetime,timedelta
 from io import BytesIO
-from os import listdir
-from os.path import join
+from json import dumps,loads
+from math import nan
+from mmap import mmap,ACCESS_READ
+from os import fdopen,listdir,replace,stat,unlink
+from os.path import basename,dirname,exists,join
 from pytz import utc
 from sys import exit
-from markdown2 import markdown
-from weasyprint import HTML
+from tempfile import mkstemp
+from threading import Event,Lock,Thread
 
-from .config import LOGGER,TIDES_DELIMITER,TIDES_DIRECTORY,TIDES_ENCODING,TIDES_TIMEZONE
+from .config import LOGGER,TIDES_DELIMITER,TIDES_DIRECTORY,TIDES_ENCODING,TIDES_INDEX_HEADER,TIDES_INDEX_MAGIC,TIDES_INDEX_SUFFIX,TIDES_PRERENDER_LEAD,TIDES_RENDER_CACHE_SIZE,TIDES_SCAN_WORKERS,TIDES_TIMEZONE
+from .metrics import increment,timed
 from .printer import print_pdf
+from .render import render,start as render_start
 
 ICON_HIGH_TIDE = '<svg height="1em" width="1em" xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24"><path d="M20 7H22V9H20C18.62 9 17.26 8.65 16 8C13.5 9.3 10.5 9.3 8 8C6.74 8.65 5.37 9 4 9H2V7H4C5.39 7 6.78 6.53 8 5.67C10.44 7.38 13.56 7.38 16 5.67C17.22 6.53 18.61 7 20 7M12 11L16 15H13V22H11V15H8L12 11Z" /></svg>'
 ICON_LOW_TIDE = '<svg height="1em" width="1em" xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24"><path d="M20 7H22V9H20C18.62 9 17.26 8.65 16 8C13.5 9.3 10.5 9.3 8 8C6.74 8.65 5.37 9 4 9H2V7H4C5.39 7 6.78 6.53 8 5.67C10.44 7.38 13.56 7.38 16 5.67C17.22 6.53 18.61 7 20 7M12 22L8 18H11V11H13V18H16L12 22Z" /></svg>'
@@ -40,10 +49,11 @@ def check_requirements(configuration):
             checklist[station].update({year:False})
 
     LOGGER.debug("Check what files should be present...")
-    #  parse files and fill checklist
+    #  read the headers of all files in parallel and fill checklist
     files = _get_files()
-    for file in files:
-        meta_data = _get_meta_data(_get_data_from_file(file))
+    with ThreadPoolExecutor(max_workers=max(1, min(TIDES_SCAN_WORKERS, len(files)))) as executor:
+        all_meta_data = list(executor.map(_read_meta_data, files))
+    for meta_data in all_meta_data:
         try:
             checklist[meta_data["station"]][meta_data["year"]] = True
         except KeyError:
@@ -71,7 +81,8 @@ def check_requirements(configuration):
 def _get_files() -> list:
     """return file locations as a list"""
     LOGGER.debug("Get all tide files")
-    files = listdir(TIDES_DIRECTORY)
+    # indexes and their temporary files, e.g. left by a crash, are no tide files
+    files = [file for file in listdir(TIDES_DIRECTORY) if not file.endswith((TIDES_INDEX_SUFFIX, ".tmp"))]
     full_files = [join(TIDES_DIRECTORY,file) for file in files]
     full_files.sort()
     return full_files
@@ -81,11 +92,22 @@ def _get_data_from_file(file) -> list:
     data = []
 
     LOGGER.debug("Read data from file: %s" % file)
-    file_in = open(file,"r",encoding=TIDES_ENCODING)
-    for row in reader(file_in,delimiter=TIDES_DELIMITER):
-        data.append(row)
+    with open(file,"r",encoding=TIDES_ENCODING) as file_in:
+        for row in reader(file_in,delimiter=TIDES_DELIMITER):
+            data.append(row)
     return data
 
+def _read_meta_data(file) -> dict:
+    """read only the header rows of a file and return its meta data"""
+    header = []
+    with open(file,"r",encoding=TIDES_ENCODING) as file_in:
+        for row in reader(file_in,delimiter=TIDES_DELIMITER):
+            # the meta data rows precede the tide events
+            if row and row[0] == "VB2":
+                break
+            header.append(row)
+    return _get_meta_data(header)
+
 def _get_tide_data(data) -> list:
     """return a list with all tide events"""
     tide_data = []
@@ -109,23 +131,148 @@ def _get_meta_data(data) -> dict:
     data = {"station": station,"name": name, "year": year}
     return data
 
-def _filter_data_for_relevant_data(tide_data) -> list:
-    """filter data fot the last 2 and next 2 events based on current time"""
-    LOGGER.debug("Filter for the last 2 and next 2 tide events")
-    current_time = datetime.now(utc).astimezone(TIDES_TIMEZONE)
-    previous_two = []
-    next_two = []
-
-    for i, row in enumerate(tide_data):
+class TideIndex:
+    """compiled tide events of one tide file: columns of epoch timestamps, heights, tide types and moon phases"""
+    def __init__(self, meta_data, timestamps, heights, tide_types, moon_phases):
+        self.meta_data = meta_data
+        self.timestamps = timestamps
+        self.heights = heights
+        self.tide_types = tide_types
+        self.moon_phases = moon_phases
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def event(self, position) -> tuple:
+        """return (timestamp, tide type, moon phase, height) of an event"""
+        return (self.timestamps[position], chr(self.tide_types[position]).strip(), chr(self.moon_phases[position]).strip(), self.heights[position])
+
+def _compile_index(file) -> TideIndex:
+    """parse a tide file into a TideIndex"""
+    data = _get_data_from_file(file)
+    meta_data = _get_meta_data(data)
+    tide_data = _get_tide_data(data)
+
+    timestamps = array('q')
+    heights = array('f')
+    tide_types = bytearray()
+    moon_phases = bytearray()
+    for row in tide_data:
         row_date = datetime.strptime(row[5].replace(" ","") + ";"+ row[6].replace(" ","") + ";+0100", "%d.%m.%Y;%H:%M;%z")
-
-        if row_date > current_time:
-            previous_two = tide_data[max(0, i-2):i]
-            next_two = tide_data[i:min(i+2, len(tide_data))]
-            break
-
-    relevant_tide_events = previous_two + next_two
-    return relevant_tide_events
+        timestamps.append(int(row_date.timestamp()))
+        height = row[7].replace(" ","")
+        heights.append(float(height) if height else nan)
+        tide_types += (row[3].strip() or " ")[0].encode("ascii", "replace")
+        moon_phases += (row[2].strip() or " ")[0].encode("ascii", "replace")
+    # heights are printed with the precision of the source file
+    heights_text = [row[7].replace(" ","") for row in tide_data if "." in row[7]]
+    meta_data["height_decimals"] = len(heights_text[0].split(".")[1]) if heights_text else 0
+    return TideIndex(meta_data, memoryview(timestamps), memoryview(heights), bytes(tide_types), bytes(moon_phases))
+
+def _write_index(index, index_file, source_stat) -> None:
+    """store a TideIndex next to its tide file"""
+    meta_data = dumps(index.meta_data).encode()
+    header = TIDES_INDEX_HEADER.pack(TIDES_INDEX_MAGIC, source_stat.st_mtime_ns, source_stat.st_size, len(index), len(meta_data))
+    # the timestamp column is 8 byte aligned for the memory mapped view
+    padding = b"\0" * (-(len(header) + len(meta_data)) % 8)
+    # every writer gets its own temporary file, so concurrent compiles of the same file never mix their writes
+    descriptor, temporary_file = mkstemp(dir=dirname(index_file), prefix=basename(index_file) + ".", suffix=".tmp")
+    try:
+        with fdopen(descriptor, "wb") as index_out:
+            index_out.write(header + meta_data + padding)
+            index_out.write(index.timestamps)
+            index_out.write(index.heights)
+            index_out.write(index.tide_types)
+            index_out.write(index.moon_phases)
+        replace(temporary_file, index_file)
+    except BaseException:
+        unlink(temporary_file)
+        raise
+
+def _read_index(index_file, source_stat):
+    """memory map a stored TideIndex, return None if it is missing or outdated"""
+    if not exists(index_file):
+        return None
+    with open(index_file, "rb") as index_in:
+        mapped = mmap(index_in.fileno(), 0, access=ACCESS_READ)
+    if len(mapped) < TIDES_INDEX_HEADER.size:
+        return None
+    magic, mtime, size, count, meta_length = TIDES_INDEX_HEADER.unpack_from(mapped)
+    if magic != TIDES_INDEX_MAGIC or mtime != source_stat.st_mtime_ns or size != source_stat.st_size:
+        return None
+    view = memoryview(mapped)
+    offset = TIDES_INDEX_HEADER.size
+    meta_data = loads(bytes(view[offset:offset + meta_length]))
+    offset += meta_length + (-(offset + meta_length) % 8)
+    timestamps = view[offset:offset + count * 8].cast('q')
+    offset += count * 8
+    heights = view[offset:offset + count * 4].cast('f')
+    offset += count * 4
+    tide_types = view[offset:offset + count]
+    offset += count
+    moon_phases = view[offset:offset + count]
+    return TideIndex(meta_data, timestamps, heights, tide_types, moon_phases)
+
+_INDEXES = {}
+
+def _get_index(file) -> TideIndex:
+    """return the compiled index of a tide file, it is only rebuilt if the file's mtime or size changed"""
+    source_stat = stat(file)
+    cached = _INDEXES.get(file)
+    if cached is not None and cached[0] == (source_stat.st_mtime_ns, source_stat.st_size):
+        return cached[1]
+
+    index_file = file + TIDES_INDEX_SUFFIX
+    index = _read_index(index_file, source_stat)
+    if index is None:
+        LOGGER.debug("Compile index for tide file: %s" % file)
+        index = _compile_index(file)
+        try:
+            _write_index(index, index_file, source_stat)
+        except OSError as exception:
+            LOGGER.warning("Could not store index for tide file %s: %s", file, exception)
+    _INDEXES[file] = ((source_stat.st_mtime_ns, source_stat.st_size), index)
+    return index
+
+class TideTimeline:
+    """all tide events of one station sorted by time, spanning all of its tide files"""
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self.timestamps = array('q')
+        # (index, position) of each event in timestamps
+        self.events = []
+        for index in sorted([index for index in indexes if len(index) > 0], key=lambda index: index.timestamps[0]):
+            for position in range(len(index)):
+                # files of consecutive years may overlap at the turn of the year
+                if self.timestamps and index.timestamps[position] <= self.timestamps[-1]:
+                    continue
+                self.timestamps.append(index.timestamps[position])
+                self.events.append((index, position))
+
+    def window(self, timestamp, previous, following) -> tuple:
+        """return the last previous and the next following events around a timestamp"""
+        boundary = bisect_right(self.timestamps, timestamp)
+        previous_events = [index.event(position) for index, position in self.events[max(0, boundary - previous):boundary]]
+        next_events = [index.event(position) for index, position in self.events[boundary:boundary + following]]
+        return previous_events, next_events
+
+_TIMELINES = {}
+
+def _get_timeline(station, indexes) -> TideTimeline:
+    """return the timeline of a station, it is only rebuilt if one of its indexes changed"""
+    cached = _TIMELINES.get(station)
+    if cached is None or len(cached.indexes) != len(indexes) or any(a is not b for a, b in zip(cached.indexes, indexes)):
+        LOGGER.debug("Build tide timeline for station: %s" % station)
+        cached = TideTimeline(indexes)
+        _TIMELINES[station] = cached
+    return cached
+
+def _filter_data_for_relevant_data(timeline, configuration, current_time) -> tuple:
+    """filter data for the last and next events based on current time"""
+    previous = configuration["tide"]["previous_events"]
+    following = configuration["tide"]["next_events"]
+    LOGGER.debug("Filter for the last %d and next %d tide events", previous, following)
+    return timeline.window(int(current_time.timestamp()), previous, following)
 
 def _generate_tide_type_text(tide_type:str):
     """return corresponding icon based on tide type"""
@@ -167,38 +314,33 @@ def _combine_data(configuration) -> dict:
     LOGGER.debug("Combine all data from all stations")
     files = _get_files()
     for file in files:
-        data = _get_data_from_file(file)
-        meta_data = _get_meta_data(data)
-        tide_data = _get_tide_data(data)
+        index = _get_index(file)
+        meta_data = index.meta_data
         if meta_data["station"] not in configuration["tide"]["stations"]:
             continue
         if meta_data["station"] in all_data.keys():
-            all_data[meta_data["station"]]['data'] += tide_data
+            all_data[meta_data["station"]]['indexes'].append(index)
         else:
-            new_data = {meta_data["station"]:{"name": meta_data["name"],"data": tide_data}}
+            new_data = {meta_data["station"]:{"name": meta_data["name"],"height_decimals": meta_data["height_decimals"],"indexes": [index]}}
             all_data.update(new_data)
 
+    for station in all_data:
+        all_data[station]["timeline"] = _get_timeline(station, all_data[station].pop("indexes"))
+
     LOGGER.debug(all_data.keys())
 
     LOGGER.debug("Data from all stations acquired")
     return all_data
 
+@timed("tide_render")
 def _create_pdf(markdown_text: str) -> BytesIO:
     """convert markdown text to pdf"""
-    pdf_out_bytes = BytesIO()
     LOGGER.debug("Convert markdown to pdf file")
-    # markdown to html
-    html_content = markdown(markdown_text)
-    # html to pdf
-    HTML(string=html_content).write_pdf(pdf_out_bytes)
-
-    return pdf_out_bytes
-
-def create_tide_overview(configuration):
-    """parse tide data and print pdf"""
-    _current_time = datetime.now().astimezone()
-    all_data = _combine_data(configuration)
+    # markdown to html to pdf in the render worker process
+    return BytesIO(render(markdown_text))
 
+def _generate_markdown(all_data, windows, _current_time) -> str:
+    """generate the markdown text of the overview"""
     LOGGER.debug("Generating markdown data from tide data")
     # generate header
     output_text = f"# Gezeiten Übersicht {_current_time.strftime('%d.%m.%Y')}\n\n" + \
@@ -209,35 +351,19 @@ def create_tide_overview(configuration):
 
     # create data for each station
     for data in all_data:
-        filtered_data = _filter_data_for_relevant_data(all_data[data]["data"])
+        previous_events, next_events = windows[data]
 
-        output_text += f"### {all_data[data]["name"]}"
+        output_text += f"### {all_data[data]['name']}"
         output_text += "\n"
         output_text += "<table>\n"
-        output_text += "<tr>\n"
-        output_text += f"<td>{_generate_tide_type_icon(filtered_data[0][3])}Letztes {_generate_tide_type_text(filtered_data[0][3])}</td>\n"
-        output_text += f"<td>{datetime.strptime(filtered_data[0][6].replace(" ","") + "+0100","%H:%M%z").astimezone(_current_time.tzinfo).strftime("%H:%M")} Uhr</td>"
-        output_text += f"<td>{filtered_data[0][7].replace(" ","").replace(".",",")}m</td>\n"
-        output_text += f"<td>{_generate_moon_icon(filtered_data[0][2])}</td>\n"
-        output_text += "</tr>\n"
-        output_text += "<tr>\n"
-        output_text += f"<td>{_generate_tide_type_icon(filtered_data[1][3])}Letztes {_generate_tide_type_text(filtered_data[1][3])}</td>\n"
-        output_text += f"<td>{datetime.strptime(filtered_data[1][6].replace(" ","") + "+0100","%H:%M%z").astimezone(_current_time.tzinfo).strftime("%H:%M")} Uhr</td>"
-        output_text += f"<td>{filtered_data[1][7].replace(" ","").replace(".",",")}m</td>\n"
-        output_text += f"<td>{_generate_moon_icon(filtered_data[1][2])}</td>\n"
-        output_text += "</tr>\n"
-        output_text += "<tr>\n"
-        output_text += f"<td>{_generate_tide_type_icon(filtered_data[2][3])}Nächstes {_generate_tide_type_text(filtered_data[2][3])}</td>\n"
-        output_text += f"<td>{datetime.strptime(filtered_data[2][6].replace(" ","") + "+0100","%H:%M%z").astimezone(_current_time.tzinfo).strftime("%H:%M")} Uhr</td>"
-        output_text += f"<td>{filtered_data[2][7].replace(" ","").replace(".",",")}m</td>\n"
-        output_text += f"<td>{_generate_moon_icon(filtered_data[2][2])}</td>\n"
-        output_text += "</tr>\n"
-        output_text += "<tr>\n"
-        output_text += f"<td>{_generate_tide_type_icon(filtered_data[3][3])}Nächstes {_generate_tide_type_text(filtered_data[3][3])}</td>\n"
-        output_text += f"<td>{datetime.strptime(filtered_data[3][6].replace(" ","") + "+0100","%H:%M%z").astimezone(_current_time.tzinfo).strftime("%H:%M")} Uhr</td>"
-        output_text += f"<td>{filtered_data[3][7].replace(" ","").replace(".",",")}m</td>"
-        output_text += f"<td>{_generate_moon_icon(filtered_data[3][2])}</td>\n"
-        output_text += "</tr>\n"
+        rows = [("Letztes", event) for event in previous_events] + [("Nächstes", event) for event in next_events]
+        for label, (timestamp, tide_type, moon_phase, height) in rows:
+            output_text += "<tr>\n"
+            output_text += f"<td>{_generate_tide_type_icon(tide_type)}{label} {_generate_tide_type_text(tide_type)}</td>\n"
+            output_text += f"<td>{datetime.fromtimestamp(timestamp, _current_time.tzinfo).strftime('%H:%M')} Uhr</td>"
+            output_text += f"<td>{height:.{all_data[data]['height_decimals']}f}".replace(".",",") + "m</td>\n"
+            output_text += f"<td>{_generate_moon_icon(moon_phase)}</td>\n"
+            output_text += "</tr>\n"
         output_text += "</table>\n"
         output_text += "\n"
         output_text += "---\n"
@@ -251,6 +377,87 @@ def create_tide_overview(configuration):
     output_text += 'Vollmond: ' + ICON_FULL_MOON + '\n'
     output_text += 'Letzter Halbmond: ' + ICON_LAST_QUARTER_MOON + '</span>\n\n'
     output_text += f"\n<span style=\"font-size:0.65em;\">Stand: {_current_time.strftime('%d.%m.%Y, %H:%M Uhr')}</br>Quelle: " + QUELLE_URL + "</span>\n\n"
+    return output_text
+
+_RENDER_CACHE = OrderedDict()
+# held while rendering, so the pre-render and a print worker never render the same overview twice
+_RENDER_LOCK = Lock()
 
-    pdf_bytes = _create_pdf(output_text)
-    print_pdf(pdf_bytes.getvalue(),configuration['printer']['name'])
+def _get_overview(configuration, current_time) -> bytes:
+    """return the overview pdf for a point in time, it is only rendered if an event window or the date changed"""
+    all_data = _combine_data(configuration)
+    windows = {station: _filter_data_for_relevant_data(all_data[station]["timeline"], configuration, current_time) for station in all_data}
+    key = (current_time.strftime('%d.%m.%Y'), tuple((station, tuple(event[0] for event in windows[station][0]), tuple(event[0] for event in windows[station][1])) for station in windows))
+
+    with _RENDER_LOCK:
+        if key in _RENDER_CACHE:
+            LOGGER.debug("Using cached tide overview")
+            increment("tide_overviews_total", result="cached")
+            _RENDER_CACHE.move_to_end(key)
+            return _RENDER_CACHE[key]
+        pdf_bytes = _create_pdf(_generate_markdown(all_data, windows, current_time)).getvalue()
+        increment("tide_overviews_total", result="rendered")
+        _RENDER_CACHE[key] = pdf_bytes
+        while len(_RENDER_CACHE) > TIDES_RENDER_CACHE_SIZE:
+            _RENDER_CACHE.popitem(last=False)
+        return pdf_bytes
+
+def _next_boundary(configuration, current_time) -> datetime:
+    """return the time of the next tide event of all stations or the next midnight, whichever is first"""
+    boundary = (current_time + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    all_data = _combine_data(configuration)
+    for station in all_data:
+        timestamps = all_data[station]["timeline"].timestamps
+        position = bisect_right(timestamps, int(current_time.timestamp()))
+        if position < len(timestamps):
+            boundary = min(boundary, datetime.fromtimestamp(timestamps[position], current_time.tzinfo))
+    return boundary
+
+def _prerender(configuration, stop) -> None:
+    """render the current overview and each following one shortly before its event boundary"""
+    current_time = datetime.now().astimezone()
+    while not stop.is_set():
+        try:
+            _get_overview(configuration, current_time)
+            current_time = _next_boundary(configuration, current_time)
+        except Exception as exception:
+            LOGGER.warning("Could not pre-render tide overview: %s", exception)
+            current_time = datetime.now().astimezone() + timedelta(seconds=TIDES_PRERENDER_LEAD)
+        if stop.wait(max(0, (current_time - datetime.now().astimezone()).total_seconds() - TIDES_PRERENDER_LEAD)):
+            return
+        # render the overview as it will look from the boundary on
+        if datetime.now().astimezone() > current_time:
+            current_time = datetime.now().astimezone()
+
+def start_render_worker() -> None:
+    """start the render worker, warmed up with the fonts and styles of an empty overview"""
+    render_start(_generate_markdown({}, {}, datetime.now().astimezone()))
+
+_PRERENDER = None
+
+def start_prerender(configuration) -> None:
+    """start pre-rendering tide overviews in the background"""
+    global _PRERENDER
+    if _PRERENDER is None:
+        stop = Event()
+        thread = Thread(target=_prerender, args=(configuration, stop), name="tide-prerender", daemon=True)
+        thread.start()
+        _PRERENDER = (thread, stop)
+
+def stop_prerender() -> None:
+    """stop pre-rendering tide overviews"""
+    global _PRERENDER
+    if _PRERENDER is not None:
+        thread, stop = _PRERENDER
+        stop.set()
+        thread.join()
+        _PRERENDER = None
+
+def get_tide_overview(configuration) -> bytes:
+    """return the pdf of the current tide overview"""
+    return _get_overview(configuration, datetime.now().astimezone())
+
+def create_tide_overview(configuration, printer=None, server=None):
+    """parse tide data and print pdf"""
+    pdf_bytes = get_tide_overview(configuration)
+    print_pdf(pdf_bytes,printer or configuration['printer']['name'],server)
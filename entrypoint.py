@@ -1,5 +1,7 @@
 """mailAttachmentPrinter entrypoint"""
+from sys import argv
 from core import main
 
 if __name__=='__main__':
-    main()
+    # --check-only validates the configuration and requirements, reports the startup timings and exits
+    main(check_only="--check-only" in argv[1:])